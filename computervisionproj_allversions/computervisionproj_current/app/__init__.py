@@ -9,6 +9,15 @@ from .search_annotation import init_app as init_search_annotation
 from .generate_image import init_app as init_generate_image
 from .fetch_annotation import init_app as init_fetch_annotations
 from .generate_video import init_app as init_generate_video  # Added import
+from .model_registry import init_app as init_model_registry
+from .inference_scheduler import init_app as init_inference_scheduler
+from .overlay_track import init_app as init_overlay_track
+from .label_intervals import init_app as init_label_intervals
+from .detection_store import init_app as init_detection_store
+from .detection_catalog import init_app as init_detection_catalog
+from .spatial_index import init_app as init_spatial_index
+from .label_query import init_app as init_label_query
+from .embedding_index import init_app as init_embedding_index
 from .config import upload_folder
 
 # Setup logging
@@ -37,6 +46,15 @@ def create_app():
     init_generate_image(app)
     init_fetch_annotations(app)
     init_generate_video(app)  # Initialize generate_video module
+    init_model_registry(app)
+    init_inference_scheduler(app)
+    init_overlay_track(app)
+    init_label_intervals(app)
+    init_detection_store(app)
+    init_detection_catalog(app)
+    init_spatial_index(app)
+    init_label_query(app)
+    init_embedding_index(app)
 
     # Additional routes initialization
     init_routes(app)
@@ -1,12 +1,21 @@
 from flask import jsonify
 import os
 from .config import upload_folder
+from .detection_store import detection_tables
+from .label_index import label_indexes
+from .spatial_index import spatial_indexes
+from .embedding_index import embedding_indexes
 
 def init_app(app):
     @app.route('/clear', methods=['POST'])
     def clear_files():
         # Logic to clear uploaded files
         try:
+            # Cached tables map files that are about to be removed
+            detection_tables.clear()
+            label_indexes.clear()
+            spatial_indexes.clear()
+            embedding_indexes.clear()
             for filename in os.listdir(upload_folder):
                 file_path = os.path.join(upload_folder, filename)
                 os.remove(file_path)
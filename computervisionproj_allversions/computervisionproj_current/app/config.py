@@ -1,6 +1,5 @@
 # config.py
 import os
-from pycocotools.coco import COCO
 
 # Ensure the 'uploads' folder exists
 upload_folder = os.path.join(os.path.dirname(__file__), 'static', 'uploads')
@@ -10,8 +9,70 @@ os.makedirs(upload_folder, exist_ok=True)
 COCO_ANNOTATIONS_PATH = r'C:\Users\krish\Documents\Project\FeatureRecall\impfiles\DataDirectory\Common_Objects_COCO\annotations\instances_val2017.json'
 COCO_IMAGES_PATH = r'C:\Users\krish\Documents\Project\FeatureRecall\impfiles\DataDirectory\Common_Objects_COCO\val2017'
 
-# Initialize COCO API for instance annotations
-coco = COCO(COCO_ANNOTATIONS_PATH)
-
 # Score threshold
 SCORE_THRESHOLD = 0.8
+
+# Memory budget (MB) for detection models kept resident by the model registry.
+# Least recently used models are evicted once the budget is exceeded.
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get('MODEL_MEMORY_BUDGET_MB', 1024))
+
+# Named model selections accepted by /upload, /process-image and /process-video
+MODEL_PROFILES = {
+    'fast': ['ssdlite320'],
+    'balanced': ['fasterrcnn'],
+    'full': ['fasterrcnn', 'keypointrcnn', 'retinanet', 'ssdlite320', 'maskrcnn'],
+}
+
+# Frames sent through the detector per call by /process-video ('auto' tunes it per video)
+VIDEO_BATCH_SIZE = 1
+VIDEO_MAX_BATCH_SIZE = 16
+
+# Micro-batching of concurrent /process-image requests per model
+INFERENCE_MICRO_BATCHING = True
+INFERENCE_MAX_BATCH_SIZE = 8
+INFERENCE_MAX_WAIT_MS = 5
+
+# Change score (0-1) below which /process-video reuses the previous detections
+SCENE_CHANGE_THRESHOLD = 0.03
+
+# Tracker used to carry boxes across frames the video detector skipped
+TRACKER_IOU_THRESHOLD = 0.3
+TRACKER_MAX_AGE = 3  # Detector runs a track may go unmatched before it is dropped
+
+# Frames buffered between /process-video pipeline stages before the upstream stage blocks
+VIDEO_PIPELINE_QUEUE_SIZE = 4
+
+# Worker processes available to sharded /process-video runs (each holds its own models)
+VIDEO_SHARD_WORKERS = int(os.environ.get('VIDEO_SHARD_WORKERS', os.cpu_count() or 1))
+
+# Video detection rows are appended to the CSV every N rows or every few seconds
+DETECTION_CSV_CHUNK_ROWS = 1000
+DETECTION_CSV_FLUSH_SECONDS = 5
+
+# Seconds between checkpoints of a running /process-video job
+VIDEO_CHECKPOINT_SECONDS = 10
+
+# Most frames /process-video holds for single-pass rendering before forcing a partial batch
+VIDEO_RENDER_MAX_BUFFERED_FRAMES = 64
+
+# /generate-video splits videos of at least this many frames per worker across the shard pool
+VIDEO_RENDER_MIN_SEGMENT_FRAMES = 300
+
+# Detections of a label less than this far apart are merged into one interval of the label index
+LABEL_INTERVAL_MAX_GAP_MS = 1000
+
+# SQLite catalog of every stored detection, indexed by upload, model, label, frame and score
+DETECTION_CATALOG_PATH = os.path.join(upload_folder, 'detections.sqlite')
+
+# Memory budget (MB) for parsed detection tables kept by the detection store's LRU cache
+DETECTION_TABLE_CACHE_MB = float(os.environ.get('DETECTION_TABLE_CACHE_MB', 256))
+
+# Cell size (px) of the grid spatial index kept next to every detection file
+SPATIAL_GRID_CELL_PX = 128
+
+# Object embeddings: R-CNN box features stored per detection, PCA-reduced to EMBEDDING_DIM
+# float16 dimensions in the in-memory similarity index (EMBEDDING_DIM * 2 bytes per detection)
+EMBEDDING_DIM = int(os.environ.get('EMBEDDING_DIM', 128))
+EMBEDDING_PCA_SAMPLE_ROWS = 20000  # Most embeddings the PCA basis is fitted on
+EMBEDDING_SEARCH_CHUNK_ROWS = 65536  # Rows scored per matrix product by exact search
+EMBEDDING_IVF_NPROBE = 8  # Lists an IVF search scans
@@ -0,0 +1,270 @@
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+from itertools import repeat
+from typing import List, Optional, Tuple
+from flask import jsonify, request
+from .config import DETECTION_CATALOG_PATH, upload_folder
+from .detection_store import load_detections
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    file_name TEXT PRIMARY KEY,
+    upload TEXT NOT NULL,
+    model TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    cataloged_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS detections (
+    file_name TEXT NOT NULL,
+    upload TEXT NOT NULL,
+    model TEXT NOT NULL,
+    label TEXT NOT NULL,
+    frame INTEGER,
+    timestamp REAL,
+    score REAL NOT NULL,
+    x1 REAL NOT NULL,
+    y1 REAL NOT NULL,
+    x2 REAL NOT NULL,
+    y2 REAL NOT NULL,
+    track_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_detections_file_label ON detections (file_name, label);
+CREATE INDEX IF NOT EXISTS idx_detections_upload_model_frame ON detections (upload, model, frame);
+CREATE INDEX IF NOT EXISTS idx_detections_label_score ON detections (label, score);
+CREATE INDEX IF NOT EXISTS idx_detections_model_label ON detections (model, label);
+-- Covers score-range searches without labels, which aggregate per file and label from the index alone
+CREATE INDEX IF NOT EXISTS idx_detections_score_file_label ON detections (score, file_name, label);
+CREATE TABLE IF NOT EXISTS file_labels (
+    file_name TEXT NOT NULL,
+    label TEXT NOT NULL,
+    matches INTEGER NOT NULL,
+    max_score REAL NOT NULL,
+    PRIMARY KEY (file_name, label)
+);
+CREATE INDEX IF NOT EXISTS idx_file_labels_label_score ON file_labels (label, max_score);
+CREATE INDEX IF NOT EXISTS idx_files_cataloged_at ON files (cataloged_at);
+'''
+
+# Orderings accepted by the global search
+SEARCH_SORTS = {
+    'score': 'max_score DESC, f.cataloged_at DESC',
+    'recency': 'f.cataloged_at DESC, max_score DESC',
+}
+MEDIA_TYPES = ('image', 'video')
+
+# Index files kept next to a detection file that share its name and extension
+SIDECAR_SUFFIXES = ('.labels.npz', '.grid.npz', '.emb.npz')
+
+DETECTION_FIELDS = ['file_name', 'upload', 'model', 'label', 'frame', 'timestamp', 'score', 'x1', 'y1', 'x2', 'y2',
+                    'track_id']
+
+
+def connect() -> sqlite3.Connection:
+    # A connection per call; /clear may remove the database file between requests
+    connection = sqlite3.connect(DETECTION_CATALOG_PATH, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')  # Readers don't block the writer
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def parse_detection_file_name(file_name: str) -> Tuple[str, str]:
+    # '<model>_detections_<upload>.npz' -> (model, upload)
+    model_name, _, upload = os.path.splitext(os.path.basename(file_name))[0].partition('_detections_')
+    return model_name, upload
+
+
+def catalog_detections(detections_path: str, media_type: Optional[str] = None) -> int:
+    # Replaces whatever the catalog held for this file
+    start_time = time.time()
+    table = load_detections(detections_path)
+    file_name = os.path.basename(table.path)
+    model_name, upload = parse_detection_file_name(file_name)
+    media_type = media_type or ('video' if table.is_video else 'image')
+
+    count = len(table)
+    boxes = table.boxes
+    if table.is_video:
+        frames = table.columns['frame'].tolist()
+        timestamps = table.columns['timestamp'].tolist()
+        track_ids = [track_id if track_id >= 0 else None for track_id in table.columns['track_id'].tolist()]
+    else:
+        frames, timestamps, track_ids = repeat(None, count), repeat(None, count), repeat(None, count)
+    rows = zip(repeat(file_name, count), repeat(upload, count), repeat(model_name, count), table.labels().tolist(),
+               frames, timestamps, table.scores.tolist(), boxes[:, 0].tolist(), boxes[:, 1].tolist(),
+               boxes[:, 2].tolist(), boxes[:, 3].tolist(), track_ids)
+
+    with closing(connect()) as connection, connection:
+        connection.execute('DELETE FROM detections WHERE file_name = ?', (file_name,))
+        connection.execute('DELETE FROM file_labels WHERE file_name = ?', (file_name,))
+        connection.executemany(f"INSERT INTO detections ({', '.join(DETECTION_FIELDS)}) "
+                               f"VALUES ({', '.join('?' * len(DETECTION_FIELDS))})", rows)
+        # One summary row per label keeps the global search independent of the number of detections
+        connection.execute('INSERT INTO file_labels SELECT file_name, label, COUNT(*), MAX(score) FROM detections '
+                           'WHERE file_name = ? GROUP BY label', (file_name,))
+        connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (file_name, upload, model_name, media_type, count, os.path.getmtime(table.path),
+                            time.time()))
+    logging.info(f"Cataloged {count} detections of {file_name} in {time.time() - start_time:.3f}s")
+    return count
+
+
+def query_detections(labels=None, models=None, uploads=None, min_score=None, frame_from=None, frame_to=None,
+                     limit: int = 1000) -> List[dict]:
+    # Cross-file query; every filter is optional
+    clauses, params = [], []
+    for column, values in (('label', labels), ('model', models), ('upload', uploads)):
+        if values:
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+    if min_score is not None:
+        clauses.append('score >= ?')
+        params.append(min_score)
+    if frame_from is not None:
+        clauses.append('frame >= ?')
+        params.append(frame_from)
+    if frame_to is not None:
+        clauses.append('frame <= ?')
+        params.append(frame_to)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+
+    with closing(connect()) as connection:
+        connection.row_factory = sqlite3.Row
+        return [dict(row) for row in connection.execute(f"SELECT * FROM detections {where} LIMIT ?",
+                                                        [*params, limit])]
+
+
+_synced = False
+
+
+def sync_catalog() -> int:
+    # Adds detection files written before the catalog existed, and label summaries
+    # of files cataloged before file_labels existed
+    from .detection_store import DETECTION_STORE_EXTENSION
+
+    with closing(connect()) as connection:
+        known = {file_name for (file_name,) in connection.execute('SELECT file_name FROM files')}
+        with connection:
+            connection.execute('INSERT INTO file_labels SELECT file_name, label, COUNT(*), MAX(score) FROM detections '
+                               'WHERE file_name NOT IN (SELECT file_name FROM file_labels) '
+                               'GROUP BY file_name, label')
+
+    added = 0
+    for file_name in os.listdir(upload_folder):
+        if '_detections_' not in file_name or file_name in known:
+            continue
+        if file_name.endswith(DETECTION_STORE_EXTENSION) and not file_name.endswith(SIDECAR_SUFFIXES):
+            catalog_detections(os.path.join(upload_folder, file_name))
+            added += 1
+    return added
+
+
+def string_list(data: dict, name: str) -> Optional[List[str]]:
+    # A bare string would otherwise be bound character by character into the IN (...) clause
+    values = data.get(name)
+    if values is not None and (not isinstance(values, list) or not all(isinstance(value, str) for value in values)):
+        raise ValueError(f"{name} must be a list of strings")
+    return values or None
+
+
+def search_uploads(labels=None, models=None, media_type=None, min_score=None, max_score=None, sort='score',
+                   page: int = 1, page_size: int = 50) -> dict:
+    # One result per detection file (an upload processed by one model). Without a score range the
+    # file_labels summary answers it; with one, matches and max_score are aggregated over the
+    # detections inside the range, so they describe the same boxes the filter selected.
+    global _synced
+    if not _synced:
+        sync_catalog()
+        _synced = True
+
+    label_clause = f"label IN ({', '.join('?' * len(labels))})" if labels else None
+    source_params = []
+    if min_score is None and max_score is None:
+        source = 'file_labels'
+    else:
+        source_clauses = []
+        if label_clause:
+            source_clauses.append(label_clause)
+            source_params.extend(labels)
+        if min_score is not None:
+            source_clauses.append('score >= ?')
+            source_params.append(min_score)
+        if max_score is not None:
+            source_clauses.append('score <= ?')
+            source_params.append(max_score)
+        source = (f"(SELECT file_name, label, COUNT(*) AS matches, MAX(score) AS max_score FROM detections "
+                  f"WHERE {' AND '.join(source_clauses)} GROUP BY file_name, label)")
+
+    clauses, params = [], []
+    if label_clause:
+        clauses.append(f"l.{label_clause}")
+        params.extend(labels)
+    if models:
+        clauses.append(f"f.model IN ({', '.join('?' * len(models))})")
+        params.extend(models)
+    if media_type:
+        clauses.append('f.media_type = ?')
+        params.append(media_type)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    params = [*source_params, *params]
+
+    query = (f"SELECT l.file_name, f.upload, f.model, f.media_type, f.cataloged_at, "
+             f"SUM(l.matches) AS matches, MAX(l.max_score) AS max_score, GROUP_CONCAT(l.label) AS labels "
+             f"FROM {source} l JOIN files f ON f.file_name = l.file_name {where} GROUP BY l.file_name")
+    with closing(connect()) as connection:
+        connection.row_factory = sqlite3.Row
+        total = connection.execute(f"SELECT COUNT(*) FROM ({query})", params).fetchone()[0]
+        rows = connection.execute(f"{query} ORDER BY {SEARCH_SORTS[sort]} LIMIT ? OFFSET ?",
+                                  [*params, page_size, (page - 1) * page_size]).fetchall()
+
+    results = []
+    for row in rows:
+        result = dict(row)
+        result['labels'] = sorted(result['labels'].split(','))
+        results.append(result)
+    return {'results': results, 'total': total, 'page': page, 'page_size': page_size}
+
+
+def init_app(app):
+    @app.route('/global-search', methods=['POST'])
+    def global_search():
+        # Searches every processed upload, not only the files the client names
+        data = request.json or {}
+        media_type = data.get('media_type')
+        sort = data.get('sort', 'score')
+
+        if sort not in SEARCH_SORTS:
+            return jsonify({'error': f"Unknown sort '{sort}', expected one of {list(SEARCH_SORTS)}"}), 400
+        if media_type is not None and media_type not in MEDIA_TYPES:
+            return jsonify({'error': f"Unknown media_type '{media_type}', expected one of {list(MEDIA_TYPES)}"}), 400
+        try:
+            labels = string_list(data, 'labels') or ([str(data['label'])] if data.get('label') else None)
+            models = string_list(data, 'models')
+            min_score = float(data['min_score']) if data.get('min_score') is not None else None
+            max_score = float(data['max_score']) if data.get('max_score') is not None else None
+            page = max(1, int(data.get('page', 1)))
+            page_size = min(max(1, int(data.get('page_size', 50))), 500)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid search parameters: {e}'}), 400
+
+        start_time = time.time()
+        response = search_uploads(labels, models, media_type, min_score, max_score, sort, page, page_size)
+        response['query_time'] = time.time() - start_time
+        return jsonify(response), 200
+
+    @app.route('/catalog-query', methods=['POST'])
+    def catalog_query():
+        data = request.json or {}
+        try:
+            rows = query_detections(labels=string_list(data, 'labels'), models=string_list(data, 'models'),
+                                    uploads=string_list(data, 'uploads'),
+                                    min_score=float(data['min_score']) if data.get('min_score') is not None else None,
+                                    frame_from=data.get('frame_from'), frame_to=data.get('frame_to'),
+                                    limit=int(data.get('limit', 1000)))
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid catalog query: {e}'}), 400
+        return jsonify({'detections': rows, 'count': len(rows)})
@@ -0,0 +1,399 @@
+import io
+import logging
+import mmap
+import os
+import struct
+import threading
+import zipfile
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from flask import jsonify, request
+from .config import upload_folder, DETECTION_TABLE_CACHE_MB
+from .detection_writer import DetectionCsvWriter, VIDEO_DETECTION_COLUMNS
+from .get_coco_categories import get_coco_categories
+
+DETECTION_STORE_EXTENSION = '.npz'
+
+# Typed columns of a detection file. Video files add the per-frame columns;
+# source_frame and track_id hold -1 where the CSV had no value.
+COLUMN_DTYPES = {
+    'boxes': np.float32,  # (N, 4) x1, y1, x2, y2
+    'scores': np.float32,
+    'category_ids': np.int16,  # COCO ids; labels outside COCO get negative ids
+    'timestamp': np.float64,
+    'frame': np.int32,
+    'inferred': np.bool_,
+    'source_frame': np.int32,
+    'track_id': np.int32,
+}
+IMAGE_DETECTION_COLUMNS = ['boxes', 'scores', 'labels']
+
+
+def store_path(path: str) -> str:
+    # Detection files are addressed by their old CSV names as well as by their store names
+    return os.path.splitext(path)[0] + DETECTION_STORE_EXTENSION
+
+
+def encode_labels(label_names) -> Tuple[np.ndarray, Dict[int, str]]:
+    # Each distinct name is looked up once, then broadcast back to the rows
+    unique_names, inverse = np.unique(np.asarray(label_names, dtype=str), return_inverse=True)
+    name_to_id = {name: category_id for category_id, name in get_coco_categories().items()}
+    unique_ids = np.empty(len(unique_names), dtype=np.int16)
+    category_names = {}
+    next_unknown_id = -1
+    for index, name in enumerate(unique_names.tolist()):
+        category_id = name_to_id.get(name)
+        if category_id is None:
+            category_id = next_unknown_id
+            next_unknown_id -= 1
+        unique_ids[index] = category_id
+        category_names[category_id] = name
+    return unique_ids[inverse.reshape(-1)], category_names
+
+
+def write_detection_store(path: str, columns: Dict[str, np.ndarray], category_names: Dict[int, str],
+                          sampling: Optional[Dict[str, float]] = None) -> str:
+    # sampling describes which frames of a video the detections cover (see FrameSampler.describe)
+    arrays = {name: np.ascontiguousarray(values, dtype=COLUMN_DTYPES[name]) for name, values in columns.items()}
+    arrays['boxes'] = arrays['boxes'].reshape(-1, 4)
+    category_ids = sorted(category_names)
+    arrays['category_table_ids'] = np.array(category_ids, dtype=np.int16)
+    arrays['category_table_names'] = np.array([category_names[category_id] for category_id in category_ids], dtype=str)
+    for name, value in (sampling or {}).items():
+        arrays[f'sampling_{name}'] = np.array(value)
+
+    # Drop the cached mappings first; Windows refuses to replace a mapped file.
+    # A cached spatial index holds on to its table, so it goes too.
+    from .spatial_index import spatial_index_path, spatial_indexes
+
+    detection_tables.evict(path)
+    spatial_indexes.evict(spatial_index_path(path))
+    return atomic_savez(path, **arrays)
+
+
+def write_image_detections(path: str, boxes, scores, label_names) -> str:
+    category_ids, category_names = encode_labels(label_names or [])
+    return write_detection_store(path, {
+        'boxes': np.array(boxes or [], dtype=np.float32).reshape(-1, 4),
+        'scores': scores or [],
+        'category_ids': category_ids,
+    }, category_names)
+
+
+def parse_boxes(values: pd.Series) -> np.ndarray:
+    # '[x1, y1, x2, y2]' strings, split in one vectorized pass instead of eval() per row
+    if values.empty:
+        return np.empty((0, 4), dtype=np.float32)
+    return values.astype(str).str.strip('[]').str.split(',', expand=True).astype(np.float32).to_numpy()
+
+
+def convert_csv_to_store(csv_path: str, remove_csv: bool = True,
+                         sampling: Optional[Dict[str, float]] = None) -> str:
+    df = pd.read_csv(csv_path)
+    if 'bounding_boxes' in df.columns:
+        category_ids, category_names = encode_labels(df['label'].astype(str).to_numpy())
+        columns = {
+            'boxes': parse_boxes(df['bounding_boxes']),
+            'scores': df['score'].to_numpy(),
+            'category_ids': category_ids,
+            'timestamp': df['timestamp'].to_numpy(),
+            'frame': df['frame'].to_numpy(),
+            'inferred': (df['inferred'].astype(str) == 'True').to_numpy(),
+            'source_frame': df['source_frame'].fillna(-1).to_numpy(),
+            'track_id': df['track_id'].fillna(-1).to_numpy(),
+        }
+    else:
+        category_ids, category_names = encode_labels(df['labels'].astype(str).to_numpy())
+        columns = {
+            'boxes': parse_boxes(df['boxes']),
+            'scores': df['scores'].to_numpy(),
+            'category_ids': category_ids,
+        }
+
+    path = write_detection_store(store_path(csv_path), columns, category_names, sampling)
+    if remove_csv:
+        os.remove(csv_path)
+    logging.info(f"Converted {csv_path} to {path} ({len(df)} rows)")
+    return path
+
+
+def map_npz(path: str) -> Optional[Dict[str, np.ndarray]]:
+    # np.load copies every .npz member into memory. Members of an uncompressed archive are
+    # stored contiguously, so they are mapped in place instead; None means fall back to np.load.
+    with open(path, 'rb') as store_file:
+        if os.fstat(store_file.fileno()).st_size == 0:
+            return None
+        buffer = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    arrays = {}
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED or not info.filename.endswith('.npy'):
+                return None
+            # Local file header: 30 fixed bytes, then the name and extra field
+            name_length, extra_length = struct.unpack('<HH', buffer[info.header_offset + 26:info.header_offset + 30])
+            data_offset = info.header_offset + 30 + name_length + extra_length
+
+            member = io.BytesIO(buffer[data_offset:data_offset + min(info.file_size, 65536)])
+            version = np.lib.format.read_magic(member)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(member)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(member)
+            else:
+                return None
+            if dtype.hasobject:
+                return None
+            arrays[info.filename[:-len('.npy')]] = np.ndarray(shape, dtype=dtype, buffer=buffer,
+                                                              offset=data_offset + member.tell(),
+                                                              order='F' if fortran_order else 'C')
+    return arrays
+
+
+def load_npz(path: str) -> Dict[str, np.ndarray]:
+    arrays = map_npz(path)
+    if arrays is None:
+        with np.load(path) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+    return arrays
+
+
+def atomic_savez(path: str, **arrays: np.ndarray) -> str:
+    # Written uncompressed, so load_npz can map it, and moved into place once complete so readers never
+    # see a partial file. Callers evict their cached mappings of path first.
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as npz_file:
+        np.savez(npz_file, **arrays)
+    os.replace(temp_path, path)
+    return path
+
+
+class FileCache:
+    """Objects loaded from files, keyed by path and the mtime the file had when it was loaded."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, path: str, mtime: float):
+        with self._lock:
+            cached = self._entries.get(path)
+        return cached[1] if cached is not None and cached[0] == mtime else None
+
+    def store(self, path: str, mtime: float, value) -> None:
+        with self._lock:
+            self._entries[path] = (mtime, value)
+
+    def evict(self, path: str) -> None:
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class DetectionTable:
+    """The detections of one image or video as NumPy columns (see COLUMN_DTYPES).
+
+    Arrays are read-only views over the memory-mapped store file. sampling holds what the
+    video pipeline recorded about the frames it examined; it is empty for images and for
+    videos processed before it was recorded."""
+
+    def __init__(self, path: str, columns: Dict[str, np.ndarray], category_names: Dict[int, str],
+                 sampling: Optional[Dict[str, float]] = None):
+        self.path = path
+        self.columns = columns
+        self.category_names = category_names
+        self.sampling = sampling or {}
+        table_ids = sorted(category_names)
+        self._table_ids = np.array(table_ids, dtype=np.int16)
+        self._table_names = np.array([category_names[category_id] for category_id in table_ids], dtype=object)
+
+    def nbytes(self) -> int:
+        return sum(values.nbytes for values in self.columns.values())
+
+    def __len__(self) -> int:
+        return len(self.columns['scores'])
+
+    @property
+    def is_video(self) -> bool:
+        return 'frame' in self.columns
+
+    @property
+    def boxes(self) -> np.ndarray:
+        return self.columns['boxes']
+
+    @property
+    def scores(self) -> np.ndarray:
+        return self.columns['scores']
+
+    @property
+    def category_ids(self) -> np.ndarray:
+        return self.columns['category_ids']
+
+    def labels(self, indices=None) -> np.ndarray:
+        # Label name per row, resolved through the category table rather than stored per row
+        category_ids = self.category_ids if indices is None else self.category_ids[indices]
+        if not len(category_ids):
+            return np.array([], dtype=object)
+        return self._table_names[np.searchsorted(self._table_ids, category_ids)]
+
+    def label_names(self) -> List[str]:
+        return [self.category_names[int(category_id)] for category_id in np.unique(self.category_ids)]
+
+    def label_mask(self, predicate: Callable[[str], bool]) -> np.ndarray:
+        # The predicate runs once per category, the row selection is a single np.isin
+        matching_ids = [category_id for category_id, name in self.category_names.items() if predicate(name)]
+        return np.isin(self.category_ids, np.array(matching_ids, dtype=np.int16))
+
+    def rows(self, indices=None) -> Iterator[dict]:
+        # Rows in the old CSV layout, for CSV export and JSON responses
+        if indices is None:
+            indices = np.arange(len(self))
+        labels = self.labels(indices)
+        boxes = self.boxes[indices].tolist()
+        scores = self.scores[indices].tolist()
+        if not self.is_video:
+            for box, score, label in zip(boxes, scores, labels):
+                yield {'boxes': box, 'scores': score, 'labels': label}
+            return
+
+        timestamps = self.columns['timestamp'][indices].tolist()
+        frames = self.columns['frame'][indices].tolist()
+        inferred = self.columns['inferred'][indices].tolist()
+        source_frames = self.columns['source_frame'][indices].tolist()
+        track_ids = self.columns['track_id'][indices].tolist()
+        for row in zip(timestamps, frames, labels, boxes, scores, inferred, source_frames, track_ids):
+            row = dict(zip(VIDEO_DETECTION_COLUMNS, row))
+            row['source_frame'] = row['source_frame'] if row['source_frame'] >= 0 else None
+            row['track_id'] = row['track_id'] if row['track_id'] >= 0 else None
+            yield row
+
+
+class DetectionTableCache:
+    """Keeps recently used detection tables in memory, keyed by store path and mtime,
+    evicting the least recently used ones once their columns exceed the memory budget."""
+
+    def __init__(self, memory_budget_mb: float):
+        self._budget_bytes = int(memory_budget_mb * 1024 * 1024)
+        self._tables: 'OrderedDict[str, Tuple[Tuple[float, int], DetectionTable]]' = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> DetectionTable:
+        stat = os.stat(path)
+        version = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            cached = self._tables.get(path)
+            if cached is not None and cached[0] == version:
+                self._tables.move_to_end(path)
+                self._stats['hits'] += 1
+                return cached[1]
+            self._stats['misses'] += 1
+            if cached is not None:
+                # The file was rewritten since it was cached
+                self._stats['invalidations'] += 1
+                self._drop(path)
+
+        table = read_detections(path)
+        with self._lock:
+            if path in self._tables:
+                self._drop(path)
+            self._tables[path] = (version, table)
+            self._sizes[path] = table.nbytes()
+            self._evict_over_budget(keep=path)
+        return table
+
+    def evict(self, path: str) -> None:
+        with self._lock:
+            if path in self._tables:
+                self._drop(path)
+                self._stats['evictions'] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tables.clear()
+            self._sizes.clear()
+
+    def stats(self) -> Dict[str, any]:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'hit_rate': self._stats['hits'] / lookups if lookups else None,
+                'tables': len(self._tables),
+                'resident_mb': sum(self._sizes.values()) / (1024 * 1024),
+                'budget_mb': self._budget_bytes / (1024 * 1024),
+            }
+
+    def _evict_over_budget(self, keep: str) -> None:
+        # Caller holds self._lock; the table just loaded is always kept
+        while sum(self._sizes.values()) > self._budget_bytes:
+            victim = next((path for path in self._tables if path != keep), None)
+            if victim is None:
+                break
+            self._drop(victim)
+            self._stats['evictions'] += 1
+
+    def _drop(self, path: str) -> None:
+        del self._tables[path]
+        del self._sizes[path]
+
+
+detection_tables = DetectionTableCache(DETECTION_TABLE_CACHE_MB)
+
+
+def read_detections(path: str) -> DetectionTable:
+    arrays = load_npz(path)
+    category_names = dict(zip(arrays.pop('category_table_ids').tolist(), arrays.pop('category_table_names').tolist()))
+    sampling = {name[len('sampling_'):]: arrays.pop(name).item()
+                for name in list(arrays) if name.startswith('sampling_')}
+    return DetectionTable(path, arrays, category_names, sampling)
+
+
+def load_detections(path: str) -> DetectionTable:
+    path = store_path(path)
+    if not os.path.exists(path):
+        csv_path = os.path.splitext(path)[0] + '.csv'
+        if not os.path.exists(csv_path):
+            raise FileNotFoundError(f"No detections stored for {os.path.basename(path)}")
+        # Uploads processed before the store existed are converted on first use
+        convert_csv_to_store(csv_path, remove_csv=False)
+    return detection_tables.get(path)
+
+
+def export_csv(path: str) -> str:
+    table = load_detections(path)
+    csv_path = os.path.splitext(table.path)[0] + '.csv'
+    columns = VIDEO_DETECTION_COLUMNS if table.is_video else IMAGE_DETECTION_COLUMNS
+    with DetectionCsvWriter({'export': csv_path}, columns) as writer:
+        for row in table.rows():
+            writer.write('export', row)
+    return csv_path
+
+
+def init_app(app):
+    @app.route('/detection-cache-stats', methods=['GET'])
+    def detection_cache_stats():
+        return jsonify(detection_tables.stats()), 200
+
+    @app.route('/export-csv', methods=['POST'])
+    def export_detections_csv():
+        # CSV is no longer the stored format; it is written on request
+        data = request.json
+        file_name = data.get('file_name')
+        if not file_name:
+            return jsonify({'error': 'No file_name provided'}), 400
+
+        try:
+            csv_path = export_csv(os.path.join(upload_folder, os.path.basename(file_name)))
+        except FileNotFoundError as e:
+            return jsonify({'error': str(e)}), 404
+
+        csv_file_name = os.path.basename(csv_path)
+        return jsonify({'csv_file_name': csv_file_name, 'csv_path': os.path.join('uploads', csv_file_name)})
@@ -0,0 +1,84 @@
+import csv
+import io
+import time
+from typing import Dict, Iterable
+from .config import DETECTION_CSV_CHUNK_ROWS, DETECTION_CSV_FLUSH_SECONDS
+
+# Column order of video detection CSVs
+VIDEO_DETECTION_COLUMNS = ['timestamp', 'frame', 'label', 'bounding_boxes', 'score', 'inferred', 'source_frame',
+                           'track_id']
+
+
+class DetectionCsvWriter:
+    """Appends detection rows to one CSV per model in fixed-size chunks.
+
+    Only the current chunk is held in memory, so memory stays flat however long the
+    video is. Each chunk is written with a single write and flushed, which keeps the
+    file readable, and never ends mid-line, while processing is still running."""
+
+    def __init__(self, paths: Dict[str, str], columns=VIDEO_DETECTION_COLUMNS, chunk_rows: int = DETECTION_CSV_CHUNK_ROWS,
+                 flush_seconds: float = DETECTION_CSV_FLUSH_SECONDS, append: bool = False):
+        self.paths = paths
+        self.columns = columns
+        self.chunk_rows = max(1, chunk_rows)
+        self.flush_seconds = flush_seconds
+        self.rows_written = {model_name: 0 for model_name in paths}
+        self._buffers = {model_name: [] for model_name in paths}
+        self._files = {}
+        self._last_flush = time.time()
+
+        for model_name, path in paths.items():
+            self._files[model_name] = open(path, 'a' if append else 'w', newline='')
+            if not append or self._files[model_name].tell() == 0:
+                self._write_lines(model_name, [self.columns])
+
+    def write(self, model_name: str, row: dict) -> None:
+        self._buffers[model_name].append([self._format(row.get(column)) for column in self.columns])
+        if (len(self._buffers[model_name]) >= self.chunk_rows
+                or time.time() - self._last_flush >= self.flush_seconds):
+            self.flush()
+
+    def write_raw(self, model_name: str, values: Iterable) -> None:
+        # Rows already in CSV column order, e.g. copied from another detection file
+        self._buffers[model_name].append(list(values))
+        if len(self._buffers[model_name]) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        for model_name, buffer in self._buffers.items():
+            if buffer:
+                self._write_lines(model_name, buffer)
+                self.rows_written[model_name] += len(buffer)
+                buffer.clear()
+        self._last_flush = time.time()
+
+    def offsets(self) -> Dict[str, int]:
+        # Byte size of each file; only meaningful right after flush()
+        return {model_name: detection_file.tell() for model_name, detection_file in self._files.items()}
+
+    def close(self) -> None:
+        self.flush()
+        for detection_file in self._files.values():
+            detection_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_lines(self, model_name: str, lines) -> None:
+        chunk = io.StringIO()
+        csv.writer(chunk).writerows(lines)
+        detection_file = self._files[model_name]
+        detection_file.write(chunk.getvalue())
+        detection_file.flush()
+
+    @staticmethod
+    def _format(value):
+        # Matches what DataFrame.to_csv wrote before: lists as their repr, None as an empty field
+        if value is None:
+            return ''
+        if isinstance(value, list):
+            return str(value)
+        return value
@@ -0,0 +1,403 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from flask import jsonify, request
+from .config import (upload_folder, EMBEDDING_DIM, EMBEDDING_PCA_SAMPLE_ROWS, EMBEDDING_SEARCH_CHUNK_ROWS,
+                     EMBEDDING_IVF_NPROBE)
+from .detection_catalog import parse_detection_file_name
+from .detection_store import DETECTION_STORE_EXTENSION, atomic_savez, load_detections, load_npz, store_path
+
+EMBEDDING_SUFFIX = '.emb.npz'
+SEARCH_METHODS = ('exact', 'ivf')
+
+# Most float32 scores held at once while vectors are compared with k-means centroids
+_CENTROID_SCORE_CELLS = 1 << 24
+
+
+def embedding_path(detections_path: str) -> str:
+    return f'{os.path.splitext(store_path(detections_path))[0]}{EMBEDDING_SUFFIX}'
+
+
+def pca_path(model_name: str) -> str:
+    return os.path.join(upload_folder, f'{model_name}_embedding_pca.npz')
+
+
+def write_embeddings(detections_path: str, embeddings: np.ndarray) -> str:
+    # Full box-head features in float16, one row per detection in store order. They are only
+    # reduced when indexed, so the PCA basis can be refitted as the corpus grows.
+    return atomic_savez(embedding_path(detections_path), embeddings=np.ascontiguousarray(embeddings, dtype=np.float16))
+
+
+def read_embeddings(path: str) -> np.ndarray:
+    return load_npz(path)['embeddings']
+
+
+def fit_pca(sample: np.ndarray, dim: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Principal axes are the eigenvectors of the covariance, largest eigenvalue first
+    sample = sample.astype(np.float32)
+    mean = sample.mean(axis=0)
+    centered = sample - mean
+    _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+    components = eigenvectors[:, ::-1][:, :dim].T
+    return mean, np.ascontiguousarray(components, dtype=np.float32)
+
+
+def project(raw: np.ndarray, mean: np.ndarray, components: np.ndarray) -> np.ndarray:
+    # Reduced vectors are unit length, so a dot product is their cosine similarity
+    reduced = np.empty((len(raw), len(components)), dtype=np.float16)
+    for start in range(0, len(raw), EMBEDDING_SEARCH_CHUNK_ROWS):
+        chunk = (raw[start:start + EMBEDDING_SEARCH_CHUNK_ROWS].astype(np.float32) - mean) @ components.T
+        chunk /= np.maximum(np.linalg.norm(chunk, axis=1, keepdims=True), 1e-12)
+        reduced[start:start + EMBEDDING_SEARCH_CHUNK_ROWS] = chunk
+    return reduced
+
+
+def closest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    chunk_rows = max(1, _CENTROID_SCORE_CELLS // len(centroids))
+    return np.concatenate([np.argmax(vectors[start:start + chunk_rows].astype(np.float32) @ centroids.T, axis=1)
+                           for start in range(0, len(vectors), chunk_rows)] or [np.empty(0, dtype=np.int64)])
+
+
+def build_ivf(vectors: np.ndarray, n_lists: Optional[int] = None, iterations: int = 10,
+              seed: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Spherical k-means on a sample, then each vector joins the list of its closest centroid.
+    # The positions of list i are order[pointers[i]:pointers[i + 1]].
+    start_time = time.time()
+    rng = np.random.default_rng(seed)
+    n_lists = n_lists or max(1, int(np.sqrt(len(vectors))))
+    sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), n_lists * 64), replace=False))]
+    sample = sample.astype(np.float32)
+    n_lists = min(n_lists, len(sample))
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+    for _ in range(iterations):
+        assignments = closest_centroids(sample, centroids)
+        order = np.argsort(assignments, kind='stable')
+        lists, starts = np.unique(assignments[order], return_index=True)
+        # Lists left empty keep their previous centroid
+        centroids[lists] = np.add.reduceat(sample[order], starts)
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+    assignments = closest_centroids(vectors, centroids)
+    order = np.argsort(assignments, kind='stable')
+    pointers = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+    logging.info(f"Built {n_lists}-list IVF over {len(vectors)} embeddings in {time.time() - start_time:.2f}s")
+    return centroids, order, pointers
+
+
+class EmbeddingIndex:
+    """PCA-reduced float16 embeddings of every detection one model has embedded, file after file,
+    with the label of each. Searched exactly by chunked matrix products, or through an inverted
+    file (IVF): k-means lists of which only the nprobe closest to the query are scanned."""
+
+    def __init__(self, model_name: str, source_files: Dict[str, float], file_names: List[str],
+                 file_mtimes: List[float], file_starts: np.ndarray, vectors: np.ndarray, label_ids: np.ndarray,
+                 label_names: List[str], mean: Optional[np.ndarray], components: Optional[np.ndarray],
+                 fitted_rows: int):
+        self.model_name = model_name
+        self.source_files = source_files
+        self.file_names = file_names
+        self.file_mtimes = file_mtimes
+        self.file_starts = file_starts
+        self.vectors = vectors
+        self.label_ids = label_ids
+        self.label_names = label_names
+        self.mean = mean
+        self.components = components
+        self.fitted_rows = fitted_rows
+        self._positions = {file_name: position for position, file_name in enumerate(file_names)}
+        self._ivf = None
+        self._ivf_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def nbytes(self) -> int:
+        ivf_bytes = sum(array.nbytes for array in self._ivf) if self._ivf is not None else 0
+        return self.vectors.nbytes + self.label_ids.nbytes + ivf_bytes
+
+    def position(self, file_name: str, row: int) -> int:
+        file_position = self._positions.get(file_name)
+        if file_position is None:
+            raise KeyError(f"No embeddings stored for {file_name}")
+        start, end = self.file_starts[file_position], self.file_starts[file_position + 1]
+        if not 0 <= row < end - start:
+            raise ValueError(f"Row {row} is out of range for {file_name} ({end - start} detections)")
+        return int(start + row)
+
+    def locate(self, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # (file position, row within the file) of each index position
+        file_positions = np.searchsorted(self.file_starts, positions, 'right') - 1
+        return file_positions, positions - self.file_starts[file_positions]
+
+    def ivf(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Built on the first IVF search and kept until the index is rebuilt
+        with self._ivf_lock:
+            if self._ivf is None:
+                self._ivf = build_ivf(self.vectors)
+            return self._ivf
+
+    def search(self, query: np.ndarray, k: int, method: str = 'exact', nprobe: int = EMBEDDING_IVF_NPROBE,
+               labels: Optional[List[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        if not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = query.astype(np.float32)
+        mask = None
+        if labels:
+            wanted = set(labels)
+            mask = np.isin(self.label_ids, [label_id for label_id, name in enumerate(self.label_names)
+                                            if name in wanted])
+
+        if method == 'ivf':
+            centroids, order, pointers = self.ivf()
+            probed = np.argsort(-(centroids @ query))[:nprobe]
+            positions = np.concatenate([order[pointers[list_id]:pointers[list_id + 1]] for list_id in probed])
+            if mask is not None:
+                positions = positions[mask[positions]]
+        else:
+            positions = np.flatnonzero(mask) if mask is not None else None
+        return self._top_k(query, k, positions)
+
+    def _top_k(self, query: np.ndarray, k: int, positions: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        # Only the best k of each chunk are kept, so memory stays bounded by the chunk size
+        total = len(self) if positions is None else len(positions)
+        candidates = [np.empty(0, dtype=np.int64)]
+        similarities = [np.empty(0, dtype=np.float32)]
+        for start in range(0, total, EMBEDDING_SEARCH_CHUNK_ROWS):
+            end = min(total, start + EMBEDDING_SEARCH_CHUNK_ROWS)
+            if positions is None:
+                chunk_positions = np.arange(start, end)
+                vectors = self.vectors[start:end]
+            else:
+                chunk_positions = positions[start:end]
+                vectors = self.vectors[chunk_positions]
+            scores = vectors.astype(np.float32) @ query
+            if len(scores) > k:
+                best = np.argpartition(-scores, k - 1)[:k]
+                chunk_positions, scores = chunk_positions[best], scores[best]
+            candidates.append(chunk_positions)
+            similarities.append(scores)
+
+        candidates = np.concatenate(candidates)
+        similarities = np.concatenate(similarities)
+        best = np.argsort(-similarities, kind='stable')[:k]
+        return candidates[best], similarities[best]
+
+
+def embedding_files(model_name: str) -> Dict[str, float]:
+    prefix = f'{model_name}_detections_'
+    return {file_name: os.path.getmtime(os.path.join(upload_folder, file_name))
+            for file_name in os.listdir(upload_folder)
+            if file_name.startswith(prefix) and file_name.endswith(EMBEDDING_SUFFIX)}
+
+
+def load_pca(model_name: str) -> Tuple[Optional[np.ndarray], Optional[np.ndarray], int]:
+    path = pca_path(model_name)
+    if not os.path.exists(path):
+        return None, None, 0
+    with np.load(path) as archive:
+        return archive['mean'], archive['components'], int(archive['fitted_rows'])
+
+
+def save_pca(model_name: str, mean: np.ndarray, components: np.ndarray, fitted_rows: int) -> None:
+    atomic_savez(pca_path(model_name), mean=mean, components=components, fitted_rows=np.int64(fitted_rows))
+
+
+def sample_embeddings(file_rows: Dict[str, int], sample_rows: int, seed: int = 0) -> np.ndarray:
+    # Every row is kept with the same probability, so each file contributes in proportion
+    rng = np.random.default_rng(seed)
+    rate = min(1.0, sample_rows / max(1, sum(file_rows.values())))
+    parts = []
+    for file_name, rows in file_rows.items():
+        raw = read_embeddings(os.path.join(upload_folder, file_name))
+        parts.append(raw[rng.random(rows) < rate])
+    return np.concatenate(parts)
+
+
+def build_embedding_index(model_name: str, source_files: Dict[str, float],
+                          previous: Optional[EmbeddingIndex] = None) -> EmbeddingIndex:
+    start_time = time.time()
+    detection_names = {file_name: file_name[:-len(EMBEDDING_SUFFIX)] + DETECTION_STORE_EXTENSION
+                       for file_name in source_files}
+    # Files unchanged since the previous build keep their projected vectors
+    reusable = {}
+    if previous is not None:
+        reusable = {detection_name: file_position for file_position, (detection_name, mtime) in
+                    enumerate(zip(previous.file_names, previous.file_mtimes))
+                    if source_files.get(os.path.basename(embedding_path(detection_name))) == mtime}
+
+    file_rows = {}
+    for file_name, detection_name in detection_names.items():
+        if detection_name in reusable:
+            file_position = reusable[detection_name]
+            file_rows[file_name] = int(previous.file_starts[file_position + 1] - previous.file_starts[file_position])
+        else:
+            file_rows[file_name] = len(read_embeddings(os.path.join(upload_folder, file_name)))
+
+    # A basis fitted on a small corpus is refitted each time the corpus grows fourfold,
+    # until it has seen a full sample; every file is then projected again
+    mean, components, fitted_rows = load_pca(model_name)
+    total_rows = sum(file_rows.values())
+    if total_rows and (mean is None or (fitted_rows < EMBEDDING_PCA_SAMPLE_ROWS and total_rows >= 4 * fitted_rows)):
+        sample = sample_embeddings(file_rows, EMBEDDING_PCA_SAMPLE_ROWS)
+        mean, components = fit_pca(sample, EMBEDDING_DIM)
+        fitted_rows = len(sample)
+        save_pca(model_name, mean, components, fitted_rows)
+        reusable = {}
+        logging.info(f"Fitted {len(components)}-dimension PCA basis for {model_name} on {fitted_rows} embeddings")
+
+    label_names = list(previous.label_names) if previous is not None else []
+    label_positions = {name: label_id for label_id, name in enumerate(label_names)}
+    file_names, file_mtimes, blocks, label_blocks = [], [], [], []
+    for file_name in sorted(source_files):
+        detection_name = detection_names[file_name]
+        if detection_name in reusable:
+            file_position = reusable[detection_name]
+            start, end = previous.file_starts[file_position], previous.file_starts[file_position + 1]
+            vectors = previous.vectors[start:end]
+            label_ids = previous.label_ids[start:end]
+        else:
+            try:
+                table = load_detections(os.path.join(upload_folder, detection_name))
+            except FileNotFoundError:
+                logging.warning(f"Skipping {file_name}: no detections stored for it")
+                continue
+            raw = read_embeddings(os.path.join(upload_folder, file_name))
+            if len(raw) != len(table):
+                logging.warning(f"Skipping {file_name}: {len(raw)} embeddings for {len(table)} detections")
+                continue
+            vectors = project(raw, mean, components)
+            category_ids, inverse = np.unique(table.category_ids, return_inverse=True)
+            for category_id in category_ids.tolist():
+                label_positions.setdefault(table.category_names[category_id], len(label_positions))
+            label_ids = np.array([label_positions[table.category_names[category_id]]
+                                  for category_id in category_ids.tolist()], dtype=np.int16)[inverse.reshape(-1)]
+
+        file_names.append(detection_name)
+        file_mtimes.append(source_files[file_name])
+        blocks.append(vectors)
+        label_blocks.append(label_ids)
+
+    dim = len(components) if components is not None else EMBEDDING_DIM
+    vectors = np.concatenate(blocks) if blocks else np.empty((0, dim), dtype=np.float16)
+    label_ids = np.concatenate(label_blocks) if label_blocks else np.empty(0, dtype=np.int16)
+    file_starts = np.concatenate(([0], np.cumsum([len(block) for block in blocks], dtype=np.int64)))
+    label_names = [name for name, _ in sorted(label_positions.items(), key=lambda item: item[1])]
+    logging.info(f"Indexed {len(vectors)} {model_name} embeddings from {len(file_names)} files "
+                 f"in {time.time() - start_time:.2f}s ({vectors.nbytes / (1024 * 1024):.1f} MB)")
+    return EmbeddingIndex(model_name, source_files, file_names, file_mtimes, file_starts, vectors, label_ids,
+                          label_names, mean, components, fitted_rows)
+
+
+class EmbeddingIndexCache:
+    """One EmbeddingIndex per model, rebuilt when embedding files are added, rewritten or removed.
+    A rebuild only projects the files that changed."""
+
+    def __init__(self):
+        self._indexes: Dict[str, EmbeddingIndex] = {}
+        self._build_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name: str) -> EmbeddingIndex:
+        with self._lock:
+            build_lock = self._build_locks.setdefault(model_name, threading.Lock())
+        with build_lock:
+            source_files = embedding_files(model_name)
+            with self._lock:
+                cached = self._indexes.get(model_name)
+            if cached is not None and cached.source_files == source_files:
+                return cached
+            index = build_embedding_index(model_name, source_files, cached)
+            with self._lock:
+                self._indexes[model_name] = index
+            return index
+
+    def clear(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            indexes = dict(self._indexes)
+        return {model_name: {
+            'embeddings': len(index),
+            'files': len(index.file_names),
+            'dim': index.vectors.shape[1],
+            'pca_fitted_rows': index.fitted_rows,
+            'ivf_lists': len(index._ivf[0]) if index._ivf is not None else None,
+            'resident_mb': index.nbytes() / (1024 * 1024),
+        } for model_name, index in indexes.items()}
+
+
+embedding_indexes = EmbeddingIndexCache()
+
+
+def init_app(app):
+    @app.route('/similar-objects', methods=['POST'])
+    def similar_objects():
+        # Detections that look like one given detection, across every upload embedded by the same model
+        data = request.json or {}
+        csv_file_name = data.get('csv_file_name')
+        method = data.get('method', 'exact')
+
+        if not csv_file_name or data.get('row') is None:
+            return jsonify({'error': 'No csv_file_name or row provided'}), 400
+        if method not in SEARCH_METHODS:
+            return jsonify({'error': f"Unknown method '{method}', expected one of {list(SEARCH_METHODS)}"}), 400
+        try:
+            row = int(data['row'])
+            k = min(max(1, int(data.get('k', 10))), 1000)
+            nprobe = max(1, int(data.get('nprobe', EMBEDDING_IVF_NPROBE)))
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid similarity query: {e}'}), 400
+
+        file_name = os.path.basename(store_path(csv_file_name))
+        model_name, _ = parse_detection_file_name(file_name)
+        start_time = time.time()
+        index = embedding_indexes.get(model_name)
+        try:
+            position = index.position(file_name, row)
+        except KeyError as e:
+            return jsonify({'error': e.args[0]}), 404
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        positions, similarities = index.search(index.vectors[position], k + 1, method, nprobe, data.get('labels'))
+        keep = positions != position
+        positions, similarities = positions[keep][:k], similarities[keep][:k]
+
+        matches = []
+        file_positions, rows = index.locate(positions)
+        for file_position, match_row, label_id, similarity in zip(file_positions.tolist(), rows.tolist(),
+                                                                   index.label_ids[positions].tolist(),
+                                                                   similarities.tolist()):
+            match_file_name = index.file_names[file_position]
+            try:
+                table = load_detections(os.path.join(upload_folder, match_file_name))
+            except FileNotFoundError:
+                continue
+            matches.append({
+                'file_name': match_file_name,
+                'upload': parse_detection_file_name(match_file_name)[1],
+                'row': match_row,
+                'label': index.label_names[label_id],
+                'boxes': table.boxes[match_row].tolist(),
+                'score': float(table.scores[match_row]),
+                'similarity': similarity,
+            })
+
+        return jsonify({
+            'model': model_name,
+            'label': index.label_names[index.label_ids[position]],
+            'method': method,
+            'indexed': len(index),
+            'matches': matches,
+            'query_time': time.time() - start_time,
+        }), 200
+
+    @app.route('/embedding-index-stats', methods=['GET'])
+    def embedding_index_stats():
+        return jsonify(embedding_indexes.stats()), 200
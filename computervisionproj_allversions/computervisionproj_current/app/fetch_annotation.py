@@ -1,7 +1,7 @@
 import os
-import pandas as pd
 from flask import Blueprint, jsonify, request
 from .config import upload_folder
+from .label_index import label_indexes
 
 fetch_annotations_bp = Blueprint('fetch_annotations', __name__)
 
@@ -12,15 +12,8 @@ def fetch_labels_from_csv(file_names):
         csv_file_path = os.path.join(upload_folder, csv_file_name)
 
         try:
-            df = pd.read_csv(csv_file_path)
-
-            # Extract labels from 'labels' column for detection files
-            if 'labels' in df.columns:
-                labels = df['labels'].unique().tolist()
-                labels_set.update(labels)
-            else:
-                # Unsupported file format
-                continue
+            # Only the label index is read, never the detections themselves
+            labels_set.update(label_indexes.get(csv_file_path).label_names)
 
         except Exception as e:
             print(f"Error fetching labels from {csv_file_name}: {str(e)}")
@@ -0,0 +1,191 @@
+import bisect
+import logging
+from typing import List, Optional
+
+import cv2
+import numpy as np
+from .config import SCENE_CHANGE_THRESHOLD
+
+SAMPLING_MODES = ('all', 'stride', 'fps', 'keyframes')
+SCENE_CHANGE_METHODS = ('diff', 'histogram')
+
+
+def find_keyframe_timestamps(video_path: str) -> List[float]:
+    # OpenCV does not expose keyframe flags, so the container is demuxed with PyAV.
+    # Only packet headers are read; nothing is decoded.
+    try:
+        import av
+    except ImportError:
+        raise ValueError('Keyframe sampling requires the "av" package (pip install av)')
+
+    timestamps = []
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        # OpenCV reports positions relative to the stream start, so do the same here
+        start_time = stream.start_time or 0
+        for packet in container.demux(stream):
+            if packet.is_keyframe and packet.pts is not None:
+                timestamps.append(float((packet.pts - start_time) * stream.time_base) * 1000)
+    timestamps.sort()
+    logging.info(f"Found {len(timestamps)} keyframes in {video_path}")
+    return timestamps
+
+
+class FrameSampler:
+    """Decides which decoded frames are sent to the detector."""
+
+    def __init__(self, mode: str = 'all', stride: int = 1, target_fps: Optional[float] = None,
+                 video_fps: float = 0.0, keyframe_timestamps: Optional[List[float]] = None):
+        self.mode = mode
+        self.stride = stride
+        self.target_fps = target_fps
+        self.keyframe_timestamps = keyframe_timestamps or []
+        self.video_fps = video_fps
+        # Half a frame interval absorbs rounding between container pts and OpenCV positions
+        self._tolerance_ms = 500.0 / video_fps if video_fps > 0 else 20.0
+        self._next_timestamp = 0.0
+        self.frames_seen = 0
+        self.frames_sampled = 0
+
+    def should_infer(self, frame_number: int, timestamp: float) -> bool:
+        self.frames_seen += 1
+        if self.mode == 'stride':
+            sampled = (frame_number - 1) % self.stride == 0
+        elif self.mode == 'fps':
+            sampled = timestamp + self._tolerance_ms >= self._next_timestamp
+            if sampled:
+                self._next_timestamp = max(self._next_timestamp, timestamp) + 1000.0 / self.target_fps
+        elif self.mode == 'keyframes':
+            sampled = self._is_keyframe(timestamp)
+        else:
+            sampled = True
+
+        if sampled:
+            self.frames_sampled += 1
+        return sampled
+
+    def stats(self) -> dict:
+        return {
+            'mode': self.mode,
+            'frames_total': self.frames_seen,
+            'frames_inferred': self.frames_sampled,
+            'frames_skipped': self.frames_seen - self.frames_sampled,
+        }
+
+    def interval_ms(self) -> Optional[float]:
+        # Typical time between two frames sent to the detector; None when the video reports no frame rate
+        frame_ms = 1000.0 / self.video_fps if self.video_fps > 0 else None
+        if self.mode == 'stride':
+            return frame_ms * self.stride if frame_ms else None
+        if self.mode == 'fps':
+            return max(1000.0 / self.target_fps, frame_ms or 0.0)
+        if self.mode == 'keyframes':
+            if len(self.keyframe_timestamps) < 2:
+                return None
+            return float(np.median(np.diff(self.keyframe_timestamps)))
+        return frame_ms
+
+    def frame_stride(self, tracking: bool = False) -> int:
+        # Every how many frames the detections cover: 1 when every frame gets them (all frames sampled, or the
+        # tracker filling in the skipped ones), 0 when the sampled frames follow no fixed stride
+        if tracking or self.mode == 'all':
+            return 1
+        if self.mode == 'stride':
+            return self.stride
+        return 0
+
+    def describe(self, frame_count: int, tracking: bool = False) -> dict:
+        # Kept with the detections so frames the detector never examined can be told from frames without detections
+        return {'frame_count': frame_count, 'frame_stride': self.frame_stride(tracking),
+                'frame_ms': 1000.0 / self.video_fps if self.video_fps > 0 else 0.0,
+                'interval_ms': self.interval_ms() or 0.0}
+
+    def _is_keyframe(self, timestamp: float) -> bool:
+        index = bisect.bisect_left(self.keyframe_timestamps, timestamp - self._tolerance_ms)
+        return (index < len(self.keyframe_timestamps)
+                and self.keyframe_timestamps[index] <= timestamp + self._tolerance_ms)
+
+
+def parse_sampler(data: dict, video_path: str, video_fps: float) -> FrameSampler:
+    mode = data.get('sampling', 'all')
+    if mode not in SAMPLING_MODES:
+        raise ValueError(f"Unknown sampling mode: {mode}")
+
+    if mode == 'stride':
+        stride = int(data.get('frame_stride', 1))
+        if stride < 1:
+            raise ValueError('frame_stride must be a positive integer')
+        return FrameSampler(mode, stride=stride, video_fps=video_fps)
+
+    if mode == 'fps':
+        target_fps = float(data.get('target_fps', 1))
+        if target_fps <= 0:
+            raise ValueError('target_fps must be positive')
+        return FrameSampler(mode, target_fps=target_fps, video_fps=video_fps)
+
+    if mode == 'keyframes':
+        return FrameSampler(mode, video_fps=video_fps, keyframe_timestamps=find_keyframe_timestamps(video_path))
+
+    return FrameSampler(mode, video_fps=video_fps)
+
+
+class SceneChangeGate:
+    """Skips the detector for frames that barely differ from the last inferred frame.
+
+    'diff' scores the mean absolute difference of small grayscale thumbnails,
+    'histogram' the Bhattacharyya distance between hue/saturation histograms.
+    Both scores fall in 0-1."""
+
+    def __init__(self, method: str = 'diff', threshold: float = SCENE_CHANGE_THRESHOLD):
+        self.method = method
+        self.threshold = threshold
+        self._reference = None
+        self.frames_inferred = 0
+        self.frames_reused = 0
+
+    def should_infer(self, frame) -> bool:
+        signature = self._signature(frame)
+        if self._reference is None or self._change_score(signature) >= self.threshold:
+            # Compare against the last inferred frame so slow drift still triggers eventually
+            self._reference = signature
+            self.frames_inferred += 1
+            return True
+
+        self.frames_reused += 1
+        return False
+
+    def stats(self) -> dict:
+        return {
+            'method': self.method,
+            'threshold': self.threshold,
+            'frames_inferred': self.frames_inferred,
+            'frames_reused': self.frames_reused,
+        }
+
+    def _signature(self, frame):
+        small = cv2.resize(frame, (64, 36), interpolation=cv2.INTER_AREA)
+        if self.method == 'histogram':
+            hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+            hist = cv2.calcHist([hsv], [0, 1], None, [16, 16], [0, 180, 0, 256])
+            return cv2.normalize(hist, hist).flatten()
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+    def _change_score(self, signature) -> float:
+        if self.method == 'histogram':
+            return float(cv2.compareHist(self._reference, signature, cv2.HISTCMP_BHATTACHARYYA))
+        return float(np.abs(signature - self._reference).mean()) / 255.0
+
+
+def parse_scene_change_gate(data: dict) -> Optional[SceneChangeGate]:
+    method = data.get('scene_change')
+    if not method:
+        return None
+    if method is True:
+        method = 'diff'
+    if method not in SCENE_CHANGE_METHODS:
+        raise ValueError(f"Unknown scene_change method: {method}")
+
+    threshold = float(data.get('scene_change_threshold', SCENE_CHANGE_THRESHOLD))
+    if threshold < 0:
+        raise ValueError('scene_change_threshold must not be negative')
+    return SceneChangeGate(method, threshold)
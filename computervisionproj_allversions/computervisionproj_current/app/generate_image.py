@@ -1,8 +1,10 @@
 import cv2
+import json
 import os
 import time
 from flask import jsonify, request
 from .config import upload_folder
+from .detection_store import load_detections
 
 def init_app(app):
     @app.route('/generate-image', methods=['POST'])
@@ -27,6 +29,14 @@ def init_app(app):
         for result in results:
             csv_filename = result.get('filename')
             bounding_boxes_data = result.get('boxes_data')
+            if bounding_boxes_data is None and csv_filename:
+                # No boxes sent along: draw everything stored for the file
+                try:
+                    table = load_detections(os.path.join(upload_folder, os.path.basename(csv_filename)))
+                except FileNotFoundError:
+                    return jsonify({'error': f'Detection file not found: {csv_filename}'}), 404
+                bounding_boxes_data = [{'boxes': box, 'labels': label}
+                                       for box, label in zip(table.boxes.tolist(), table.labels())]
 
             # Derive model name from CSV filename
             model_name_with_ext = os.path.splitext(csv_filename)[0]
@@ -48,11 +58,11 @@ def init_app(app):
                     label = item.get('labels')
 
                     try:
-                        # Convert string representation of list to list of ints
-                        x1, y1, x2, y2 = map(int, eval(box))
+                        # Boxes arrive as lists or as their JSON text
+                        x1, y1, x2, y2 = map(int, json.loads(box) if isinstance(box, str) else box)
                         cv2.rectangle(annotated_image, (x1, y1), (x2, y2), (255, 0, 0), 2)  # Draw rectangle with blue color
                         cv2.putText(annotated_image, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
-                    except (ValueError, SyntaxError):
+                    except (ValueError, TypeError):
                         print(f"Invalid boxes format: {box}")
                         continue
 
@@ -1,8 +1,158 @@
 import cv2
 import os
 import json
+import logging
+import shutil
+import subprocess
+import threading
+import time
 from flask import jsonify, request
-from .config import upload_folder
+from .config import upload_folder, VIDEO_RENDER_MIN_SEGMENT_FRAMES, VIDEO_SHARD_WORKERS
+from .detection_store import load_detections
+from .video_seek import seek_to_frame
+
+class VideoRenderer:
+    """Writes the annotated copy of a video while /process-video decodes it.
+
+    Decoded frames are held until the detector reports their rows complete with
+    commit(frame_number), then drawn and written in frame order."""
+
+    def __init__(self, video_name, fps, width, height):
+        self.annotated_video_filename = f'annotated_{video_name}'
+        self.annotated_video_path = os.path.join(upload_folder, self.annotated_video_filename)
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        self._out = cv2.VideoWriter(self.annotated_video_path, fourcc, fps, (width, height))
+        self._frames = []
+        self._rows_by_frame = {}
+        self._lock = threading.Lock()
+        self.frames_written = 0
+
+    def add_frame(self, frame_number, timestamp, frame):
+        with self._lock:
+            self._frames.append((frame_number, frame))
+
+    def add_row(self, row):
+        self._rows_by_frame.setdefault(row['frame'], []).append(row)
+
+    def commit(self, frame_number):
+        with self._lock:
+            ready = [item for item in self._frames if item[0] <= frame_number]
+            self._frames = [item for item in self._frames if item[0] > frame_number]
+        for number, frame in ready:
+            self._write(number, frame)
+
+    def close(self):
+        self.commit(float('inf'))
+        self._out.release()
+        print(f"Annotated video saved at: {self.annotated_video_path}")
+
+    def _write(self, frame_number, frame):
+        for row in self._rows_by_frame.pop(frame_number, []):
+            x1, y1, x2, y2 = map(int, row['bounding_boxes'])
+            cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 2)  # Draw rectangle with blue color
+            cv2.putText(frame, row['label'], (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
+        self._out.write(frame)
+        self.frames_written += 1
+
+def draw_boxes(frame, boxes):
+    for box in boxes:
+        x1, y1, x2, y2 = map(int, box)
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 2)  # Draw rectangle with blue color
+
+def render_frames(video_path, output_path, boxes_by_frame, start_frame=0, end_frame=None):
+    # Draws the decoded frames at offsets [start_frame, end_frame) into their own file; end_frame None reads
+    # to the end of the video. boxes_by_frame is keyed by frame number, which counts from 1 like the store.
+    video_capture = cv2.VideoCapture(video_path)
+    if not video_capture.isOpened():
+        raise IOError(f"Could not open video {video_path}")
+
+    fps = video_capture.get(cv2.CAP_PROP_FPS)
+    width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+
+    frames_written = 0
+    try:
+        seek_to_frame(video_capture, start_frame)
+        frame_index = start_frame
+        while end_frame is None or frame_index < end_frame:
+            ret, frame = video_capture.read()
+            if not ret:
+                break
+            if frame_index + 1 in boxes_by_frame:
+                draw_boxes(frame, boxes_by_frame[frame_index + 1])
+            out.write(frame)
+            frame_index += 1
+            frames_written += 1
+    finally:
+        video_capture.release()
+        out.release()
+    return frames_written
+
+def render_segment(video_path, part_path, boxes_by_frame, start_frame, end_frame):
+    # Runs in a shard pool worker
+    start_time = time.time()
+    frames_written = render_frames(video_path, part_path, boxes_by_frame, start_frame, end_frame)
+    return {'start_frame': start_frame, 'end_frame': end_frame, 'frames_written': frames_written,
+            'elapsed_time': time.time() - start_time}
+
+def join_segments(part_paths, output_path):
+    # Every segment starts with a keyframe, so ffmpeg's concat demuxer can copy the packets without re-encoding
+    list_path = f'{output_path}.segments.txt'
+    with open(list_path, 'w') as list_file:
+        for part_path in part_paths:
+            list_file.write(f"file '{os.path.abspath(part_path)}'\n")
+    try:
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+                        '-c', 'copy', output_path], check=True)
+    finally:
+        os.remove(list_path)
+        for part_path in part_paths:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+def render_parallel(video_path, output_path, boxes_by_frame, segments):
+    # Imported here because video_shards pulls in torch
+    from .video_shards import get_shard_pool
+
+    pool = get_shard_pool()
+    part_paths = [f'{output_path}.part{index}.mp4' for index in range(len(segments))]
+    futures = []
+    for part_path, (start_frame, end_frame) in zip(part_paths, segments):
+        # Each worker only receives the boxes of its own frames, numbered from start_frame + 1
+        segment_boxes = {frame: boxes for frame, boxes in boxes_by_frame.items()
+                         if frame > start_frame and (end_frame is None or frame <= end_frame)}
+        futures.append(pool.submit(render_segment, video_path, part_path, segment_boxes, start_frame, end_frame))
+    try:
+        segment_results = [future.result() for future in futures]
+    except Exception:
+        for part_path in part_paths:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        raise
+    join_segments(part_paths, output_path)
+    return segment_results
+
+def plan_render_segments(video_path, parallel):
+    # A single segment means the old single-threaded path
+    if not parallel or shutil.which('ffmpeg') is None:
+        return [(0, None)]
+    from .video_shards import split_segments
+
+    video_capture = cv2.VideoCapture(video_path)
+    frame_count = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    video_capture.release()
+    shards = min(VIDEO_SHARD_WORKERS, frame_count // max(1, VIDEO_RENDER_MIN_SEGMENT_FRAMES))
+    return split_segments(frame_count, shards)
+
+def stored_annotations(csv_file_name, label=None):
+    table = load_detections(os.path.join(upload_folder, os.path.basename(csv_file_name)))
+    if not table.is_video:
+        raise ValueError(f"{csv_file_name} does not hold video detections")
+    rows = table.label_mask(lambda name: name == label).nonzero()[0] if label else slice(None)
+    return [{'frame': frame, 'bounding_boxes': box}
+            for frame, box in zip(table.columns['frame'][rows].tolist(), table.boxes[rows].tolist())]
 
 def init_app(app):
     @app.route('/generate-video', methods=['POST'])
@@ -10,6 +160,16 @@ def init_app(app):
         data = request.json
         video_name = data.get('video_name')  # Changed to 'video_name' to match payload
         annotations = data.get('annotations')
+        csv_file_name = data.get('csv_file_name')
+
+        # Boxes come either with the request or straight from the stored detections
+        if video_name and annotations is None and csv_file_name:
+            try:
+                annotations = stored_annotations(csv_file_name, data.get('label'))
+            except FileNotFoundError as e:
+                return jsonify({'error': str(e)}), 404
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
 
         if not video_name or not isinstance(annotations, list) or not all(
                 isinstance(annotation, dict) for annotation in annotations):
@@ -20,58 +180,43 @@ def init_app(app):
 
         print(f"Generating annotated video for: {os.path.basename(video_path)}")
 
-        # Load the uploaded video
         video_capture = cv2.VideoCapture(video_path)
         if not video_capture.isOpened():
             return jsonify({'error': 'Could not open video'}), 400
+        video_capture.release()
 
-        # Get video properties
-        fps = video_capture.get(cv2.CAP_PROP_FPS)
-        width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        # Create a dictionary for easy lookup of annotations by frame number.
+        # Boxes are checked up front so no worker fails halfway through a segment.
+        boxes_by_frame = {}
+        for annotation in annotations:
+            box = annotation['bounding_boxes']
+            # Ensure box is a list of floats
+            if not isinstance(box, list) or len(box) != 4:
+                return jsonify({'error': 'Bounding box must be a list with four elements'}), 400
+            try:
+                box = [int(value) for value in box]
+            except (TypeError, ValueError):
+                return jsonify({'error': 'Bounding box contains non-numeric values'}), 400
+            boxes_by_frame.setdefault(int(annotation['frame']), []).append(box)
 
-        # Define the codec and create VideoWriter object
         annotated_video_filename = f'annotated_{video_name}'
         annotated_video_path = os.path.join(upload_folder, annotated_video_filename)
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(annotated_video_path, fourcc, fps, (width, height))
 
-        # Create a dictionary for easy lookup of annotations by frame number
-        annotations_by_frame = {}
-        for annotation in annotations:
-            frame_number = annotation['frame']
-            if frame_number not in annotations_by_frame:
-                annotations_by_frame[frame_number] = []
-            annotations_by_frame[frame_number].append(annotation['bounding_boxes'])
-
-        # Process video frames
-        frame_index = 0
-        while video_capture.isOpened():
-            ret, frame = video_capture.read()
-            if not ret:
-                break
-
-            # Annotate the frame with bounding boxes
-            if frame_index in annotations_by_frame:
-                for box in annotations_by_frame[frame_index]:
-                    # Ensure box is a list of floats
-                    if not isinstance(box, list) or len(box) != 4:
-                        return jsonify({'error': 'Bounding box must be a list with four elements'}), 400
-
-                    try:
-                        x1, y1, x2, y2 = map(int, box)
-                        cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 2)  # Draw rectangle with blue color
-                    except ValueError:
-                        return jsonify({'error': 'Bounding box contains non-numeric values'}), 400
-
-            out.write(frame)
-            frame_index += 1
-
-        video_capture.release()
-        out.release()
+        # Long videos are drawn in segments across the shard pool and joined without re-encoding
+        segments = plan_render_segments(video_path, data.get('parallel', True))
+        start_time = time.time()
+        if len(segments) > 1:
+            segment_results = render_parallel(video_path, annotated_video_path, boxes_by_frame, segments)
+            frames_written = sum(segment['frames_written'] for segment in segment_results)
+        else:
+            segment_results = None
+            frames_written = render_frames(video_path, annotated_video_path, boxes_by_frame)
+        logging.info(f"Rendered {frames_written} frames of {video_name} in {len(segments)} segments "
+                     f"in {time.time() - start_time:.2f}s")
         print(f"Annotated video saved at: {annotated_video_path}")
 
         # Return a relative path that Flask can serve
         relative_video_path = os.path.join('uploads', annotated_video_filename)
         return jsonify(
-            {'message': 'Annotated video generated successfully.', 'annotated_video_path': relative_video_path})
+            {'message': 'Annotated video generated successfully.', 'annotated_video_path': relative_video_path,
+             'frames_written': frames_written, 'segments': segment_results})
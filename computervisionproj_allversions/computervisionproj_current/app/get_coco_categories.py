@@ -1,7 +1,15 @@
+from functools import lru_cache
 from flask import jsonify
-from .config import coco  # Ensure coco is properly imported
+from pycocotools.coco import COCO
+from .config import COCO_ANNOTATIONS_PATH
+
+@lru_cache(maxsize=None)
+def get_coco() -> COCO:
+    # Loaded on first use rather than at import, so importing the app does not need the annotations file
+    return COCO(COCO_ANNOTATIONS_PATH)
 
 def get_coco_categories():
+    coco = get_coco()
     categories = {cat['id']: cat['name'] for cat in coco.loadCats(coco.getCatIds())}
     return categories  # Return the categories dictionary directly
 
@@ -0,0 +1,141 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+import torch
+from flask import Flask, jsonify
+from .config import INFERENCE_MAX_BATCH_SIZE, INFERENCE_MAX_WAIT_MS
+from .model_registry import ModelRegistry, model_registry
+
+
+class TorchThreadBudget:
+    """Splits torch's thread count, which is process-wide, between the inferences running at the
+    same time, and restores the process default once none is running."""
+
+    def __init__(self):
+        self._default_threads = torch.get_num_threads()
+        self._active = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def share(self):
+        with self._lock:
+            self._active += 1
+            self._apply()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._apply()
+
+    def _apply(self) -> None:
+        # Caller holds self._lock
+        if self._active:
+            torch.set_num_threads(max(1, self._default_threads // self._active))
+        else:
+            torch.set_num_threads(self._default_threads)
+
+
+torch_threads = TorchThreadBudget()
+
+
+class InferenceScheduler:
+    """Groups concurrent single-image requests for the same model into micro-batches.
+
+    Each model gets its own queue and worker thread. A worker takes the first waiting
+    image, collects more for up to max_wait_ms or until max_batch_size is reached,
+    runs them through the model in one call and hands each caller its own prediction."""
+
+    def __init__(self, registry: ModelRegistry, max_batch_size: int, max_wait_ms: float):
+        self._registry = registry
+        self._max_batch_size = max(1, int(max_batch_size))
+        self._max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queues: Dict[str, queue.Queue] = {}
+        self._stats: Dict[str, Dict[str, any]] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, model_name: str, image_tensor: torch.Tensor) -> Future:
+        if model_name not in self._registry:
+            raise KeyError(f"Unknown model: {model_name}")
+
+        future = Future()
+        self._queue_for(model_name).put((image_tensor, future))
+        return future
+
+    def infer(self, model_name: str, image_tensor: torch.Tensor) -> Dict[str, torch.Tensor]:
+        return self.submit(model_name, image_tensor).result()
+
+    def stats(self) -> Dict[str, Dict[str, any]]:
+        with self._lock:
+            report = {}
+            for model_name, stats in self._stats.items():
+                report[model_name] = {
+                    **stats,
+                    'queued': self._queues[model_name].qsize(),
+                    'mean_batch_size': stats['requests'] / stats['batches'] if stats['batches'] else None,
+                }
+            return report
+
+    def _queue_for(self, model_name: str) -> queue.Queue:
+        with self._lock:
+            request_queue = self._queues.get(model_name)
+            if request_queue is None:
+                request_queue = queue.Queue()
+                self._queues[model_name] = request_queue
+                self._stats[model_name] = {'requests': 0, 'batches': 0, 'max_batch_size': 0}
+                worker = threading.Thread(target=self._run, args=(model_name, request_queue),
+                                          name=f'inference-{model_name}', daemon=True)
+                worker.start()
+            return request_queue
+
+    def _run(self, model_name: str, request_queue: queue.Queue) -> None:
+        while True:
+            batch = [request_queue.get()]
+            deadline = time.monotonic() + self._max_wait
+            while len(batch) < self._max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(request_queue.get(timeout=remaining))
+                    else:
+                        batch.append(request_queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_batch(model_name, batch)
+
+    def _run_batch(self, model_name: str, batch: List[Tuple[torch.Tensor, Future]]) -> None:
+        with self._lock:
+            stats = self._stats[model_name]
+            stats['requests'] += len(batch)
+            stats['batches'] += 1
+            stats['max_batch_size'] = max(stats['max_batch_size'], len(batch))
+
+        try:
+            model = self._registry.get(model_name)
+            with torch_threads.share(), torch.no_grad():
+                predictions = model([image_tensor for image_tensor, _ in batch])
+            for (_, future), prediction in zip(batch, predictions):
+                future.set_result(prediction)
+        except Exception as e:
+            logging.error(f"Error running batch of {len(batch)} on model {model_name}: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+inference_scheduler = InferenceScheduler(model_registry, INFERENCE_MAX_BATCH_SIZE, INFERENCE_MAX_WAIT_MS)
+
+
+def init_app(app: Flask) -> None:
+    @app.route('/scheduler-stats', methods=['GET'])
+    def scheduler_stats():
+        return jsonify({
+            'max_batch_size': INFERENCE_MAX_BATCH_SIZE,
+            'max_wait_ms': INFERENCE_MAX_WAIT_MS,
+            'models': inference_scheduler.stats(),
+        }), 200
@@ -0,0 +1,91 @@
+import logging
+import os
+import time
+from typing import Dict, Iterable, List
+
+import numpy as np
+from .detection_store import DetectionTable, FileCache, atomic_savez, load_detections, load_npz, store_path
+
+
+def label_index_path(detections_path: str) -> str:
+    return f'{os.path.splitext(store_path(detections_path))[0]}.labels.npz'
+
+
+class LabelIndex:
+    """Inverted index of one detection file: for each label its row count, max score and
+    row offsets. Offsets are stored grouped by label (CSR layout), so the rows of a label
+    are the slice offsets[starts[i]:starts[i] + counts[i]]."""
+
+    def __init__(self, label_names: List[str], counts: np.ndarray, max_scores: np.ndarray, starts: np.ndarray,
+                 offsets: np.ndarray):
+        self.label_names = label_names
+        self.counts = counts
+        self.max_scores = max_scores
+        self.starts = starts
+        self.offsets = offsets
+        self._positions = {label: position for position, label in enumerate(label_names)}
+
+    def summary(self) -> Dict[str, dict]:
+        return {label: {'count': int(count), 'max_score': float(max_score)}
+                for label, count, max_score in zip(self.label_names, self.counts.tolist(), self.max_scores.tolist())}
+
+    def rows_for(self, labels: Iterable[str]) -> np.ndarray:
+        # Row offsets of the given labels, in file order
+        slices = [self.offsets[self.starts[position]:self.starts[position] + self.counts[position]]
+                  for position in (self._positions[label] for label in labels if label in self._positions)]
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(slices))
+
+
+def build_label_index(table: DetectionTable) -> Dict[str, np.ndarray]:
+    order = np.argsort(table.category_ids, kind='stable')
+    sorted_ids = table.category_ids[order]
+    category_ids, starts, counts = np.unique(sorted_ids, return_index=True, return_counts=True)
+    max_scores = (np.maximum.reduceat(table.scores[order], starts) if len(order)
+                  else np.empty(0, dtype=np.float32))
+    return {
+        'label_names': np.array([table.category_names[int(category_id)] for category_id in category_ids], dtype=str),
+        'counts': counts.astype(np.int64),
+        'max_scores': max_scores.astype(np.float32),
+        'starts': starts.astype(np.int64),
+        'offsets': order.astype(np.int64),
+    }
+
+
+def write_label_index(detections_path: str) -> str:
+    start_time = time.time()
+    arrays = build_label_index(load_detections(detections_path))
+    index_path = label_index_path(detections_path)
+    label_indexes.evict(index_path)
+    atomic_savez(index_path, **arrays)
+    logging.info(f"Indexed {len(arrays['label_names'])} labels of {detections_path} "
+                 f"in {time.time() - start_time:.3f}s")
+    return index_path
+
+
+class LabelIndexCache(FileCache):
+    """Keeps loaded label indexes, keyed by path and mtime. They are small, so there is no cap."""
+
+    def get(self, detections_path: str) -> LabelIndex:
+        detections_path = store_path(detections_path)
+        index_path = label_index_path(detections_path)
+        if not os.path.exists(detections_path):
+            # Converts uploads processed before the store existed, or raises FileNotFoundError
+            load_detections(detections_path)
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(detections_path):
+            # Missing for uploads processed before the index existed, stale if the detections were rewritten
+            write_label_index(detections_path)
+        mtime = os.path.getmtime(index_path)
+
+        index = self.lookup(index_path, mtime)
+        if index is not None:
+            return index
+        arrays = load_npz(index_path)
+        index = LabelIndex(arrays['label_names'].tolist(), arrays['counts'], arrays['max_scores'], arrays['starts'],
+                           arrays['offsets'])
+        self.store(index_path, mtime, index)
+        return index
+
+
+label_indexes = LabelIndexCache()
@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import time
+from typing import Dict, List
+import cv2
+import numpy as np
+from flask import jsonify, request
+from .config import upload_folder, LABEL_INTERVAL_MAX_GAP_MS
+from .detection_store import DetectionTable, FileCache, load_detections
+
+# Each interval is [start_ms, end_ms, max_score, start_frame, end_frame]
+INTERVAL_FIELDS = ['start_ms', 'end_ms', 'max_score', 'start_frame', 'end_frame']
+
+
+def interval_index_path(detections_path: str) -> str:
+    return f'{os.path.splitext(detections_path)[0]}.intervals.json'
+
+
+def interval_gap_ms(sampling_interval_ms: float = None) -> float:
+    # Sampled below 1 fps, consecutive detections are further apart than LABEL_INTERVAL_MAX_GAP_MS, so the
+    # gap is kept above the time between detector frames, with slack for timestamp jitter
+    if not sampling_interval_ms:
+        return LABEL_INTERVAL_MAX_GAP_MS
+    return max(LABEL_INTERVAL_MAX_GAP_MS, 1.5 * sampling_interval_ms)
+
+
+def build_interval_index(table: DetectionTable, max_gap_ms: float = LABEL_INTERVAL_MAX_GAP_MS) -> Dict[str, List[list]]:
+    # Rows are in frame order, so a label's timestamps are sorted and its intervals
+    # are split wherever consecutive detections are more than max_gap_ms apart
+    if not table.is_video:
+        raise ValueError(f"{os.path.basename(table.path)} does not hold video detections")
+    timestamps = table.columns['timestamp']
+    frames = table.columns['frame']
+    intervals = {}
+    for category_id in np.unique(table.category_ids):
+        rows = np.flatnonzero(table.category_ids == category_id)
+        label_timestamps = timestamps[rows]
+        breaks = np.flatnonzero(np.diff(label_timestamps) > max_gap_ms) + 1
+        starts = np.concatenate(([0], breaks))
+        ends = np.concatenate((breaks, [len(rows)]))
+        label_scores = np.maximum.reduceat(table.scores[rows], starts)
+        intervals[table.category_names[int(category_id)]] = [
+            [float(label_timestamps[start]), float(label_timestamps[end - 1]), float(score),
+             int(frames[rows[start]]), int(frames[rows[end - 1]])]
+            for start, end, score in zip(starts.tolist(), ends.tolist(), label_scores)]
+    return intervals
+
+
+def write_interval_index(detections_path: str, sampling_interval_ms: float = None) -> str:
+    # sampling_interval_ms is the time between the frames the detector was run on (see FrameSampler.interval_ms);
+    # without it the interval recorded with the detections is used
+    start_time = time.time()
+    table = load_detections(detections_path)
+    if sampling_interval_ms is None:
+        sampling_interval_ms = table.sampling.get('interval_ms')
+    max_gap_ms = interval_gap_ms(sampling_interval_ms)
+    index = {'file_name': os.path.basename(detections_path), 'fields': INTERVAL_FIELDS, 'max_gap_ms': max_gap_ms,
+             'labels': build_interval_index(table, max_gap_ms)}
+    index_path = interval_index_path(detections_path)
+    temp_path = f'{index_path}.tmp'
+    with open(temp_path, 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(temp_path, index_path)
+    logging.info(f"Indexed {len(index['labels'])} labels of {detections_path} in {time.time() - start_time:.3f}s")
+    return index_path
+
+
+class IntervalIndexCache(FileCache):
+    """Keeps loaded interval indexes in memory so repeated queries are dictionary lookups."""
+
+    def get(self, detections_path: str) -> dict:
+        index_path = interval_index_path(detections_path)
+        if not os.path.exists(index_path):
+            # Uploads processed before the index existed are indexed on first use
+            write_interval_index(detections_path)
+        mtime = os.path.getmtime(index_path)
+
+        index = self.lookup(index_path, mtime)
+        if index is not None:
+            return index
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        self.store(index_path, mtime, index)
+        return index
+
+
+interval_indexes = IntervalIndexCache()
+
+
+def find_intervals(detections_path: str, label: str, min_score: float = None) -> List[list]:
+    intervals = interval_indexes.get(detections_path)['labels'].get(label, [])
+    if min_score is not None:
+        intervals = [interval for interval in intervals if interval[2] >= min_score]
+    return intervals
+
+
+def init_app(app):
+    @app.route('/label-intervals', methods=['POST'])
+    def label_intervals():
+        data = request.json
+        csv_file_names = data.get('csv_file_names', [])
+        label = data.get('label')
+
+        if not csv_file_names or not label:
+            return jsonify({'error': 'No csv_file_names or label provided'}), 400
+
+        start_time = time.time()
+        results = []
+        try:
+            min_score = float(data['min_score']) if data.get('min_score') is not None else None
+            for csv_file_name in csv_file_names:
+                try:
+                    intervals = find_intervals(os.path.join(upload_folder, os.path.basename(csv_file_name)), label,
+                                               min_score)
+                except FileNotFoundError:
+                    print(f"Detection file not found: {csv_file_name}")
+                    continue
+                if intervals:
+                    results.append({'filename': csv_file_name, 'fields': INTERVAL_FIELDS, 'intervals': intervals})
+        except ValueError as e:
+            return jsonify({'error': f'Invalid interval query: {e}'}), 400
+
+        if not results:
+            return jsonify({'error': f'The label "{label}" does not appear in the provided files.'}), 404
+        return jsonify({'results': results, 'query_time': time.time() - start_time})
+
+    @app.route('/export-clips', methods=['POST'])
+    def export_clips():
+        # Cuts only the time ranges where a label appears, with its boxes drawn in
+        from .generate_video import render_frames
+
+        data = request.json
+        video_name = data.get('video_name')
+        csv_file_name = data.get('csv_file_name')
+        label = data.get('label')
+
+        if not video_name or not csv_file_name or not label:
+            return jsonify({'error': 'Missing video_name, csv_file_name or label'}), 400
+
+        video_path = os.path.join(upload_folder, video_name)
+        try:
+            table = load_detections(os.path.join(upload_folder, os.path.basename(csv_file_name)))
+        except FileNotFoundError as e:
+            return jsonify({'error': str(e)}), 404
+
+        video_capture = cv2.VideoCapture(video_path)
+        if not video_capture.isOpened():
+            return jsonify({'error': 'Could not open video'}), 400
+        fps = video_capture.get(cv2.CAP_PROP_FPS) or 0
+        video_capture.release()
+
+        try:
+            min_score = float(data['min_score']) if data.get('min_score') is not None else None
+            padding_frames = int(float(data.get('padding_ms', 0)) * fps / 1000)
+            max_clips = int(data.get('max_clips', 20))
+            intervals = find_intervals(table.path, label, min_score)[:max_clips]
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not intervals:
+            return jsonify({'error': f'The label "{label}" does not appear in {csv_file_name}.'}), 404
+
+        # Only the matching label's boxes are drawn
+        boxes_by_frame = {}
+        rows = table.label_mask(lambda name: name == label).nonzero()[0]
+        for frame, box in zip(table.columns['frame'][rows].tolist(), table.boxes[rows].tolist()):
+            boxes_by_frame.setdefault(frame, []).append(box)
+
+        clips = []
+        base_name, extension = os.path.splitext(video_name)
+        for clip_number, (start_ms, end_ms, max_score, start_frame, end_frame) in enumerate(intervals):
+            clip_filename = f'clip_{label}_{clip_number}_{base_name}{extension}'
+            # Frame numbers count from 1; render_frames takes decoded offsets [start, end)
+            frames_written = render_frames(video_path, os.path.join(upload_folder, clip_filename), boxes_by_frame,
+                                           max(0, start_frame - 1 - padding_frames), end_frame + padding_frames)
+            clips.append({'clip_path': os.path.join('uploads', clip_filename), 'start_ms': start_ms,
+                          'end_ms': end_ms, 'max_score': max_score, 'frames_written': frames_written})
+        print(f"Exported {len(clips)} clips of '{label}' from {video_name}")
+
+        return jsonify({'message': 'Clips exported successfully.', 'clips': clips})
@@ -0,0 +1,243 @@
+import os
+import re
+import time
+from typing import List
+
+import numpy as np
+from flask import jsonify, request
+from .config import upload_folder
+from .detection_store import DetectionTable, load_detections
+
+QUERY_SCOPES = ('frame', 'window')
+
+# Text form of a filter, e.g.  person>=3 AND (car OR truck@0.9) AND NOT "traffic light"
+# label>=N asks for at least N boxes, label@S only counts boxes scoring at least S
+_TOKEN = re.compile(r'\s*(?:(?P<op>AND|OR|NOT)\b|(?P<paren>[()])|"(?P<quoted>[^"]+)"|(?P<word>[A-Za-z_][\w-]*)'
+                    r'|>=(?P<count>\d+)|@(?P<score>\d*\.?\d+))', re.IGNORECASE)
+
+
+def tokenize(text: str) -> List[tuple]:
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None or match.end() == position:
+            raise ValueError(f"Unexpected input at position {position}: {text[position:position + 10]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        tokens.append((kind, value.upper() if kind == 'op' else value))
+        position = match.end()
+    return tokens
+
+
+def parse_query(text: str) -> dict:
+    # Recursive descent; NOT binds tighter than AND, which binds tighter than OR
+    tokens = tokenize(text)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else (None, None)
+
+    def take():
+        nonlocal position
+        token = peek()
+        position += 1
+        return token
+
+    def expression():
+        terms = [term()]
+        while peek() == ('op', 'OR'):
+            take()
+            terms.append(term())
+        return terms[0] if len(terms) == 1 else {'or': terms}
+
+    def term():
+        factors = [factor()]
+        while peek() == ('op', 'AND'):
+            take()
+            factors.append(factor())
+        return factors[0] if len(factors) == 1 else {'and': factors}
+
+    def factor():
+        kind, value = peek()
+        if (kind, value) == ('op', 'NOT'):
+            take()
+            return {'not': factor()}
+        if (kind, value) == ('paren', '('):
+            take()
+            node = expression()
+            if take() != ('paren', ')'):
+                raise ValueError('Missing closing parenthesis')
+            return node
+        if kind in ('word', 'quoted'):
+            take()
+            node = {'label': value}
+            while peek()[0] in ('count', 'score'):
+                modifier, amount = take()
+                if modifier == 'count':
+                    node['min_count'] = int(amount)
+                else:
+                    node['min_score'] = float(amount)
+            return node
+        raise ValueError(f"Expected a label, NOT or '(' but found {value or 'the end of the query'!r}")
+
+    node = expression()
+    if position != len(tokens):
+        raise ValueError(f"Unexpected {tokens[position][1]!r}")
+    return node
+
+
+class QueryUnits:
+    """The units a filter is evaluated on: every frame of a video the detector's results cover, or the whole
+    image, so frames and images without detections can still match a NOT. With a time window, a label is
+    present in a unit if it was seen in the window_ms before it, and its count is the most boxes of it seen
+    in any single frame of that window.
+
+    A video sampled with a fixed stride has one unit per sampled frame. Frames sampled by fps or keyframes
+    are not recorded individually, so such a video has a unit per frame and cannot be queried with NOT."""
+
+    def __init__(self, table: DetectionTable, window_ms: float = None):
+        self.table = table
+        self.examined_frames_known = True
+        if table.is_video:
+            frame_column = table.columns['frame'].astype(np.int64)
+            # Frames are numbered from 1; videos processed before the frame count was recorded end at
+            # their last detection
+            first_frame = min(1, int(frame_column.min())) if len(table) else 1
+            last_frame = max(int(table.sampling.get('frame_count', 0)), int(frame_column.max()) if len(table) else 0)
+            stride = int(table.sampling.get('frame_stride', 1))
+            self.examined_frames_known = stride > 0
+            stride = max(stride, 1)
+            self.frames = np.arange(first_frame, last_frame + 1, stride)
+            self.unit_of_row = (frame_column - first_frame) // stride
+            self.timestamps = self._frame_timestamps(frame_column, table.columns['timestamp'])
+        else:
+            self.frames = np.zeros(1, dtype=np.int64)
+            self.unit_of_row = np.zeros(len(self.table), dtype=np.int64)
+            self.timestamps = np.zeros(1)
+        self.window_start = (np.searchsorted(self.timestamps, self.timestamps - window_ms, 'left')
+                             if window_ms is not None else None)
+
+    def _frame_timestamps(self, frame_column: np.ndarray, timestamp_column: np.ndarray) -> np.ndarray:
+        # Frames without rows are interpolated between the frames with rows and extrapolated past them
+        known_frames, first_rows = np.unique(frame_column, return_index=True)
+        known_timestamps = timestamp_column[first_rows]
+        ms_per_frame = self.table.sampling.get('frame_ms') or 0.0
+        if not ms_per_frame and len(known_frames) > 1:
+            ms_per_frame = (known_timestamps[-1] - known_timestamps[0]) / (known_frames[-1] - known_frames[0])
+        if not len(known_frames):
+            return (self.frames - 1) * ms_per_frame
+
+        timestamps = np.interp(self.frames, known_frames, known_timestamps)
+        head = self.frames < known_frames[0]
+        timestamps[head] = known_timestamps[0] - (known_frames[0] - self.frames[head]) * ms_per_frame
+        tail = self.frames > known_frames[-1]
+        timestamps[tail] = known_timestamps[-1] + (self.frames[tail] - known_frames[-1]) * ms_per_frame
+        return timestamps
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def counts(self, row_mask: np.ndarray) -> np.ndarray:
+        counts = np.bincount(self.unit_of_row[row_mask], minlength=len(self))
+        if self.window_start is None:
+            return counts
+        return window_max(counts, self.window_start)
+
+
+def window_max(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    # max(values[starts[i]:i + 1]) for every i, from a sparse table of maxima over power-of-two spans
+    levels = [values]
+    while 2 ** len(levels) <= len(values):
+        previous, span = levels[-1], 2 ** (len(levels) - 1)
+        levels.append(np.maximum(previous[:-span], previous[span:]))
+    ends = np.arange(len(values))
+    level_of = np.floor(np.log2(ends - starts + 1)).astype(np.int64)
+    result = np.empty_like(values)
+    for level in np.unique(level_of).tolist():
+        units = np.flatnonzero(level_of == level)
+        result[units] = np.maximum(levels[level][starts[units]], levels[level][ends[units] - 2 ** level + 1])
+    return result
+
+
+def evaluate(node: dict, units: QueryUnits) -> np.ndarray:
+    # One boolean per unit; every leaf is a handful of whole-column operations
+    if not isinstance(node, dict) or len(node.keys() & {'and', 'or', 'not', 'label'}) != 1:
+        raise ValueError(f"Each filter node needs exactly one of and, or, not, label: {node!r}")
+    if 'and' in node or 'or' in node:
+        children = node.get('and', node.get('or'))
+        if not isinstance(children, list) or not children:
+            raise ValueError('and/or take a non-empty list')
+        results = [evaluate(child, units) for child in children]
+        return np.logical_and.reduce(results) if 'and' in node else np.logical_or.reduce(results)
+    if 'not' in node:
+        if not units.examined_frames_known:
+            raise ValueError(f"NOT is not supported on {os.path.basename(units.table.path)}: it was sampled "
+                             f"by fps or keyframes, which do not record the frames examined without detections")
+        return ~evaluate(node['not'], units)
+
+    table = units.table
+    row_mask = table.label_mask(lambda name: name == node['label'])
+    if node.get('min_score') is not None:
+        row_mask &= table.scores >= float(node['min_score'])
+    if node.get('max_score') is not None:
+        row_mask &= table.scores <= float(node['max_score'])
+    return units.counts(row_mask) >= int(node.get('min_count', 1))
+
+
+def matching_intervals(units: QueryUnits, matched: np.ndarray) -> List[list]:
+    # Runs of consecutive matching units as [start_ms, end_ms, start_frame, end_frame]
+    indices = np.flatnonzero(matched)
+    if not len(indices):
+        return []
+    breaks = np.flatnonzero(np.diff(indices) > 1) + 1
+    starts = indices[np.concatenate(([0], breaks))]
+    ends = indices[np.concatenate((breaks - 1, [len(indices) - 1]))]
+    return [[float(units.timestamps[start]), float(units.timestamps[end]), int(units.frames[start]),
+             int(units.frames[end])] for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def init_app(app):
+    @app.route('/query', methods=['POST'])
+    def label_query():
+        data = request.json or {}
+        csv_file_names = data.get('csv_file_names', [])
+        query = data.get('query')
+        scope = data.get('scope', 'frame')
+
+        if not csv_file_names or not query:
+            return jsonify({'error': 'No csv_file_names or query provided'}), 400
+        if scope not in QUERY_SCOPES:
+            return jsonify({'error': f"Unknown scope '{scope}', expected one of {list(QUERY_SCOPES)}"}), 400
+
+        start_time = time.time()
+        try:
+            # Either the text form or the equivalent JSON tree
+            node = parse_query(query) if isinstance(query, str) else query
+            window_ms = float(data.get('window_ms', 1000)) if scope == 'window' else None
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid query: {e}'}), 400
+
+        results = []
+        for csv_file_name in csv_file_names:
+            try:
+                table = load_detections(os.path.join(upload_folder, os.path.basename(csv_file_name)))
+            except FileNotFoundError:
+                print(f"Detection file not found: {csv_file_name}")
+                continue
+
+            units = QueryUnits(table, window_ms)
+            try:
+                matched = evaluate(node, units)
+            except (KeyError, TypeError, ValueError) as e:
+                return jsonify({'error': f'Invalid query: {e}'}), 400
+            if not matched.any():
+                continue
+
+            result = {'filename': csv_file_name, 'matched_units': int(matched.sum()), 'total_units': len(units)}
+            if table.is_video:
+                result['intervals'] = matching_intervals(units, matched)
+            results.append(result)
+
+        return jsonify({'query': node, 'results': results, 'query_time': time.time() - start_time}), 200
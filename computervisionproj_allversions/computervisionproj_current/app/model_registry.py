@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+import torch
+from flask import Flask, jsonify
+from torchvision import models
+from torchvision.models.detection import (
+    ssdlite320_mobilenet_v3_large,
+    FasterRCNN_ResNet50_FPN_Weights,
+    KeypointRCNN_ResNet50_FPN_Weights,
+    RetinaNet_ResNet50_FPN_Weights,
+    SSDLite320_MobileNet_V3_Large_Weights,
+    MaskRCNN_ResNet50_FPN_Weights
+)
+from .config import MODEL_MEMORY_BUDGET_MB, MODEL_PROFILES
+
+# Builders for the supported object detection models. Nothing is loaded until
+# a model is first requested from the registry.
+model_builders: Dict[str, Callable[[], torch.nn.Module]] = {
+    'fasterrcnn': lambda: models.detection.fasterrcnn_resnet50_fpn(weights=FasterRCNN_ResNet50_FPN_Weights.COCO_V1),
+    'keypointrcnn': lambda: models.detection.keypointrcnn_resnet50_fpn(weights=KeypointRCNN_ResNet50_FPN_Weights.COCO_V1),
+    'retinanet': lambda: models.detection.retinanet_resnet50_fpn(weights=RetinaNet_ResNet50_FPN_Weights.COCO_V1),
+    'ssdlite320': lambda: ssdlite320_mobilenet_v3_large(weights=SSDLite320_MobileNet_V3_Large_Weights.COCO_V1),
+    'maskrcnn': lambda: models.detection.maskrcnn_resnet50_fpn(weights=MaskRCNN_ResNet50_FPN_Weights.COCO_V1),
+}
+
+
+def model_size_bytes(model: torch.nn.Module) -> int:
+    # Parameters and buffers are what the model keeps resident between calls
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class ModelRegistry:
+    """Loads detection models on first use and keeps them under a memory budget,
+    evicting the least recently used ones when the budget is exceeded."""
+
+    def __init__(self, builders: Dict[str, Callable[[], torch.nn.Module]], memory_budget_mb: float):
+        self._builders = builders
+        self._budget_bytes = int(memory_budget_mb * 1024 * 1024)
+        self._models: 'OrderedDict[str, torch.nn.Module]' = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._stats: Dict[str, Dict[str, any]] = {
+            name: {'loads': 0, 'hits': 0, 'evictions': 0, 'load_time': None, 'last_used': None}
+            for name in builders
+        }
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in builders}
+
+    def names(self) -> List[str]:
+        return list(self._builders)
+
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._models)
+
+    def __contains__(self, model_name: str) -> bool:
+        return model_name in self._builders
+
+    def get(self, model_name: str) -> torch.nn.Module:
+        if model_name not in self._builders:
+            raise KeyError(f"Unknown model: {model_name}")
+
+        model = self._lookup(model_name)
+        if model is not None:
+            return model
+
+        # Only one thread builds a given model; others wait and reuse it
+        with self._load_locks[model_name]:
+            model = self._lookup(model_name)
+            if model is not None:
+                return model
+
+            start_time = time.time()
+            model = self._builders[model_name]()
+            model.eval()
+            load_time = time.time() - start_time
+            size = model_size_bytes(model)
+
+            with self._lock:
+                self._models[model_name] = model
+                self._sizes[model_name] = size
+                stats = self._stats[model_name]
+                stats['loads'] += 1
+                stats['load_time'] = load_time
+                stats['last_used'] = time.time()
+                self._evict_over_budget(keep=model_name)
+
+            logging.info(f"{model_name} model loaded in {load_time:.2f}s ({size / (1024 * 1024):.1f} MB) "
+                         f"and set to evaluation mode.")
+            return model
+
+    def evict(self, model_name: str) -> bool:
+        with self._lock:
+            if model_name not in self._models:
+                return False
+            self._drop(model_name)
+            return True
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def stats(self) -> Dict[str, Dict[str, any]]:
+        with self._lock:
+            report = {}
+            for name, stats in self._stats.items():
+                size = self._sizes.get(name)
+                report[name] = {
+                    **stats,
+                    'loaded': name in self._models,
+                    'resident_size_mb': size / (1024 * 1024) if size is not None else None,
+                }
+            return report
+
+    def _lookup(self, model_name: str) -> Optional[torch.nn.Module]:
+        with self._lock:
+            model = self._models.get(model_name)
+            if model is not None:
+                self._models.move_to_end(model_name)
+                self._stats[model_name]['hits'] += 1
+                self._stats[model_name]['last_used'] = time.time()
+            return model
+
+    def _evict_over_budget(self, keep: str) -> None:
+        # Caller holds self._lock. The model just requested is never evicted,
+        # so a single model larger than the budget still gets served.
+        while sum(self._sizes.values()) > self._budget_bytes:
+            victim = next((name for name in self._models if name != keep), None)
+            if victim is None:
+                break
+            logging.info(f"Evicting {victim} model to stay within {self._budget_bytes / (1024 * 1024):.0f} MB budget.")
+            self._drop(victim)
+
+    def _drop(self, model_name: str) -> None:
+        del self._models[model_name]
+        del self._sizes[model_name]
+        self._stats[model_name]['evictions'] += 1
+
+
+model_registry = ModelRegistry(model_builders, MODEL_MEMORY_BUDGET_MB)
+
+
+def resolve_model_names(requested_models=None, profile: Optional[str] = None,
+                        default_models: Optional[List[str]] = None) -> List[str]:
+    # Explicit model names win over a profile; with neither, fall back to the caller's default
+    if requested_models:
+        if isinstance(requested_models, str):
+            requested_models = requested_models.split(',')
+        model_names = [name.strip() for name in requested_models if name and name.strip()]
+    elif profile:
+        if profile not in MODEL_PROFILES:
+            raise ValueError(f"Unknown model profile: {profile}")
+        model_names = MODEL_PROFILES[profile]
+    else:
+        model_names = default_models if default_models is not None else model_registry.names()
+
+    unknown = [name for name in model_names if name not in model_registry]
+    if unknown:
+        raise ValueError(f"Unknown model(s): {', '.join(unknown)}")
+    if not model_names:
+        raise ValueError("No models selected")
+
+    # Drop duplicates but keep the requested order
+    return list(dict.fromkeys(model_names))
+
+
+def init_app(app: Flask) -> None:
+    @app.route('/model-stats', methods=['GET'])
+    def model_stats():
+        return jsonify({
+            'budget_mb': MODEL_MEMORY_BUDGET_MB,
+            'resident_mb': model_registry.resident_bytes() / (1024 * 1024),
+            'models': model_registry.stats(),
+            'profiles': MODEL_PROFILES,
+        }), 200
@@ -0,0 +1,114 @@
+import json
+import os
+import struct
+import numpy as np
+from flask import Response, jsonify, request
+from .config import upload_folder
+from .detection_store import load_detections
+
+OVERLAY_FORMATS = ('json', 'binary')
+OVERLAY_GROUPS = ('frame', 'track')
+
+# Binary overlay: b'OVL1', uint32 header length, JSON header, then one record per box
+OVERLAY_MAGIC = b'OVL1'
+OVERLAY_RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('frame', '<u4'),
+    ('label', '<u2'),
+    ('track_id', '<i4'),  # -1 when the video was processed without tracking
+    ('score', '<f4'),
+    ('box', '<f4', (4,)),
+])
+
+
+def build_overlay_records(table, labels=None, min_score=None):
+    # Column slices of the stored detections; rows stay in frame order
+    if not table.is_video:
+        raise ValueError('not a video detection file')
+    mask = np.ones(len(table), dtype=bool)
+    if labels is not None:
+        mask &= table.label_mask(lambda name: name in labels)
+    if min_score is not None:
+        mask &= table.scores >= min_score
+
+    category_ids = table.category_ids[mask]
+    present_ids = np.unique(category_ids)
+    records = np.empty(int(mask.sum()), dtype=OVERLAY_RECORD_DTYPE)
+    records['timestamp'] = table.columns['timestamp'][mask]
+    records['frame'] = table.columns['frame'][mask]
+    records['label'] = np.searchsorted(present_ids, category_ids)
+    records['track_id'] = table.columns['track_id'][mask]
+    records['score'] = table.scores[mask]
+    records['box'] = table.boxes[mask]
+    return [table.category_names[int(category_id)] for category_id in present_ids], records
+
+
+def overlay_by_frame(labels, records):
+    # Boxes are [x1, y1, x2, y2, label index, score, track id]
+    frames = []
+    for record in records:
+        if not frames or frames[-1]['frame'] != int(record['frame']):
+            frames.append({'timestamp': round(float(record['timestamp']), 3), 'frame': int(record['frame']),
+                           'boxes': []})
+        frames[-1]['boxes'].append([round(float(value), 1) for value in record['box']]
+                                   + [int(record['label']), round(float(record['score']), 3),
+                                      int(record['track_id'])])
+    return {'labels': labels, 'frames': frames}
+
+
+def overlay_by_track(labels, records):
+    # Samples are [timestamp, x1, y1, x2, y2, score]; the client interpolates between them
+    tracks = {}
+    for record in records:
+        track = tracks.setdefault(int(record['track_id']), {'track_id': int(record['track_id']),
+                                                            'label': labels[int(record['label'])],
+                                                            'samples': []})
+        track['samples'].append([round(float(record['timestamp']), 3)]
+                                + [round(float(value), 1) for value in record['box']]
+                                + [round(float(record['score']), 3)])
+    return {'labels': labels, 'tracks': list(tracks.values())}
+
+
+def encode_binary_overlay(labels, records):
+    header = json.dumps({'labels': labels, 'count': len(records),
+                         'dtype': OVERLAY_RECORD_DTYPE.descr}).encode('utf-8')
+    return OVERLAY_MAGIC + struct.pack('<I', len(header)) + header + records.tobytes()
+
+
+def init_app(app):
+    @app.route('/overlay-track', methods=['POST'])
+    def overlay_track():
+        # Boxes for drawing over the original video on the client, without re-encoding it
+        data = request.json
+        csv_file_name = data.get('csv_file_name')
+        output_format = data.get('format', 'json')
+        group_by = data.get('group_by', 'frame')
+
+        if not csv_file_name:
+            return jsonify({'error': 'No csv_file_name provided'}), 400
+        if output_format not in OVERLAY_FORMATS:
+            return jsonify({'error': f"Unknown format '{output_format}', expected one of {list(OVERLAY_FORMATS)}"}), 400
+        if group_by not in OVERLAY_GROUPS:
+            return jsonify({'error': f"Unknown group_by '{group_by}', expected one of {list(OVERLAY_GROUPS)}"}), 400
+
+        try:
+            table = load_detections(os.path.join(upload_folder, os.path.basename(csv_file_name)))
+        except FileNotFoundError as e:
+            return jsonify({'error': str(e)}), 404
+
+        labels = data.get('labels')
+        try:
+            min_score = float(data['min_score']) if data.get('min_score') is not None else None
+            label_names, records = build_overlay_records(table, set(labels) if labels else None, min_score)
+        except ValueError as e:
+            return jsonify({'error': f'Cannot build an overlay from {csv_file_name}: {e}'}), 400
+
+        if output_format == 'binary':
+            # The binary timeline is always per box; clients group it themselves
+            return Response(encode_binary_overlay(label_names, records), mimetype='application/octet-stream')
+
+        if group_by == 'track':
+            if len(records) and (records['track_id'] < 0).any():
+                return jsonify({'error': 'group_by=track needs a video processed with tracking'}), 400
+            return jsonify(overlay_by_track(label_names, records))
+        return jsonify(overlay_by_frame(label_names, records))
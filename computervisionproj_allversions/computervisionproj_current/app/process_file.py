@@ -29,20 +29,37 @@ def init_app(app):
             file.save(file_path)
             logging.info(f"File saved to {file_path}")
 
+            # Forward model selection: 'models' may be repeated or comma separated
+            model_selection = {}
+            requested_models = [name for value in request.form.getlist('models') for name in value.split(',') if name.strip()]
+            if requested_models:
+                model_selection['models'] = requested_models
+            if request.form.get('profile'):
+                model_selection['profile'] = request.form.get('profile')
+
             # Determine file type
             file_extension = file.filename.split('.')[-1].lower()
             if file_extension in ['jpg', 'jpeg', 'png', 'bmp', 'gif']:
                 # Process image
-                processing_response = requests.post('http://localhost:5000/process-image', json={'image_name': file.filename})
+                processing_response = requests.post('http://localhost:5000/process-image',
+                                                    json={'image_name': file.filename,
+                                                          'parallel': request.form.get('parallel') == 'true',
+                                                          'embeddings': request.form.get('embeddings') == 'true',
+                                                          **model_selection})
                 process_type = 'image'
             elif file_extension in ['mp4', 'avi', 'mov', 'wmv', 'flv', 'mkv']:
                 # Process video (assuming you have a similar endpoint for videos)
-                processing_response = requests.post('http://localhost:5000/process-video', json={'file_name': file.filename})
+                processing_response = requests.post('http://localhost:5000/process-video',
+                                                    json={'file_name': file.filename, **model_selection})
                 process_type = 'video'
             else:
                 logging.warning(f"Unsupported file type: {file_extension}")
                 return jsonify({'error': 'Unsupported file type'}), 400
 
+            if processing_response.status_code == 400:
+                logging.warning(f"{process_type.capitalize()} processing rejected: {processing_response.text}")
+                return jsonify({'error': f'{process_type.capitalize()} processing rejected', 'details': processing_response.text}), 400
+
             if processing_response.status_code != 200:
                 logging.error(f"{process_type.capitalize()} processing failed: {processing_response.text}")
                 return jsonify({'error': f'{process_type.capitalize()} processing failed', 'details': processing_response.text}), 500
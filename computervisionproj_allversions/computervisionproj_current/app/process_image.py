@@ -1,61 +1,69 @@
 import os
 import logging
 import time
+import numpy as np
 import torch
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, jsonify, request
 from PIL import Image
-from pycocotools.coco import COCO
-from .config import COCO_ANNOTATIONS_PATH, SCORE_THRESHOLD, upload_folder
-from torchvision import models, transforms
-from torchvision.models.detection import (
-    ssdlite320_mobilenet_v3_large,
-    FasterRCNN_ResNet50_FPN_Weights,
-    KeypointRCNN_ResNet50_FPN_Weights,
-    RetinaNet_ResNet50_FPN_Weights,
-    SSDLite320_MobileNet_V3_Large_Weights,
-    MaskRCNN_ResNet50_FPN_Weights
-)
+from .config import SCORE_THRESHOLD, INFERENCE_MICRO_BATCHING, upload_folder
+from torchvision import transforms
 from typing import Dict, List, Tuple, Optional
-
-# Define object detection models
-models_dict = {
-    'fasterrcnn': models.detection.fasterrcnn_resnet50_fpn(weights=FasterRCNN_ResNet50_FPN_Weights.COCO_V1),
-    'keypointrcnn': models.detection.keypointrcnn_resnet50_fpn(weights=KeypointRCNN_ResNet50_FPN_Weights.COCO_V1),
-    'retinanet': models.detection.retinanet_resnet50_fpn(weights=RetinaNet_ResNet50_FPN_Weights.COCO_V1),
-    'ssdlite320': ssdlite320_mobilenet_v3_large(weights=SSDLite320_MobileNet_V3_Large_Weights.COCO_V1),
-    'maskrcnn': models.detection.maskrcnn_resnet50_fpn(weights=MaskRCNN_ResNet50_FPN_Weights.COCO_V1),
-}
-
-# Initialize COCO API
-coco = COCO(COCO_ANNOTATIONS_PATH)
-coco_categories = coco.loadCats(coco.getCatIds())
-category_id_to_name = {category['id']: category['name'] for category in coco_categories}
-
-# Load models and set them to evaluation mode
-for model_name, model_instance in models_dict.items():
-    model_instance.eval()
-    logging.info(f"{model_name} model loaded and set to evaluation mode.")
-
-def detect_objects(model, image: Image.Image, image_name: str) -> Tuple[
-    Optional[List[List[float]]], Optional[List[float]], Optional[List[str]]]:
-    model_name = [name for name, instance in models_dict.items() if instance == model][0]
+from .model_registry import model_registry, resolve_model_names
+from .inference_scheduler import inference_scheduler, torch_threads
+from .detection_store import write_image_detections, DETECTION_STORE_EXTENSION
+from .detection_catalog import catalog_detections
+from .label_index import write_label_index
+from .spatial_index import write_spatial_index
+from .embedding_index import embedding_path, write_embeddings
+from .get_coco_categories import get_coco_categories
+
+def supports_embeddings(model) -> bool:
+    # Only the two-stage R-CNN models pool features per box
+    return hasattr(model, 'roi_heads') and hasattr(model.roi_heads, 'box_head')
+
+def detect_with_embeddings(model, image_tensor: torch.Tensor) -> Tuple[Dict[str, torch.Tensor], np.ndarray]:
+    # The steps of GeneralizedRCNN.forward in eval mode, keeping the box-head features of the
+    # final boxes, pooled from the same backbone features rather than a second forward pass
+    original_size = tuple(image_tensor.shape[-2:])
+    with torch.no_grad():
+        images, _ = model.transform([image_tensor])
+        features = model.backbone(images.tensors)
+        proposals, _ = model.rpn(images, features)
+        detections, _ = model.roi_heads(features, proposals, images.image_sizes)
+        box_features = model.roi_heads.box_roi_pool(features, [detections[0]['boxes']], images.image_sizes)
+        embeddings = model.roi_heads.box_head(box_features).flatten(start_dim=1)
+        detections = model.transform.postprocess(detections, images.image_sizes, [original_size])
+    return detections[0], embeddings.to(torch.float16).cpu().numpy()
+
+def detect_objects(model, image: Image.Image, image_name: str, model_name: str, with_embeddings: bool = False) -> Tuple[
+    Optional[List[List[float]]], Optional[List[float]], Optional[List[str]], Optional[np.ndarray]]:
     logging.info(f"Starting detection with model: {model_name}")
 
     transform = transforms.ToTensor()
-    image_tensor = transform(image).unsqueeze(0)
+    image_tensor = transform(image)
 
     try:
-        with torch.no_grad():
-            predictions = model(image_tensor)[0]  # Get the first result from the list
+        embeddings = None
+        if with_embeddings:
+            # Run outside the micro-batcher, which only hands back predictions
+            with torch_threads.share():
+                predictions, embeddings = detect_with_embeddings(model, image_tensor)
+        elif INFERENCE_MICRO_BATCHING:
+            # Batched together with concurrent requests for the same model
+            predictions = inference_scheduler.infer(model_name, image_tensor)
+        else:
+            with torch_threads.share(), torch.no_grad():
+                predictions = model(image_tensor.unsqueeze(0))[0]  # Get the first result from the list
 
-        if model_name in models_dict:
+        if model_name in model_registry:
             # Access the predictions correctly
             boxes = predictions['boxes'].tolist()
             scores = predictions['scores'].tolist()
             labels = predictions['labels'].tolist()
 
             # Map label numbers to class names
+            category_id_to_name = get_coco_categories()
             label_names = [category_id_to_name.get(int(label), 'Unknown') for label in labels]
 
             # Filter out low-confidence detections
@@ -63,46 +71,57 @@ def detect_objects(model, image: Image.Image, image_name: str) -> Tuple[
             boxes = [boxes[i] for i in high_confidence_indices]
             scores = [scores[i] for i in high_confidence_indices]
             label_names = [label_names[i] for i in high_confidence_indices]
+            if embeddings is not None:
+                embeddings = embeddings[high_confidence_indices]
 
-            return boxes, scores, label_names
+            return boxes, scores, label_names, embeddings
 
         else:
             logging.error(f"Model {model_name} is not recognized.")
-            return None, None, None
+            return None, None, None, None
 
     except Exception as e:
         logging.error(f"Error processing model {model_name}: {e}")
-        return None, None, None
+        return None, None, None, None
 
-def process_model(model_name: str, image: Image.Image, image_name: str) -> Optional[Dict[str, any]]:
+def process_model(model_name: str, image: Image.Image, image_name: str,
+                  embeddings: bool = False) -> Optional[Dict[str, any]]:
     logging.info(f"Processing model: {model_name} on file: {image_name}")
 
-    model = models_dict.get(model_name)
-    if not model:
+    if model_name not in model_registry:
         logging.error(f"Model {model_name} not found.")
         return None
 
-    start_time = time.time()
-
     try:
-        boxes, scores, label_names = detect_objects(model, image, image_name)
-
-        csv_data = {
-            'boxes': boxes,
-            'scores': scores,
-            'labels': label_names
-        }
-        csv_file_name = f'{model_name}_detections_{os.path.splitext(image_name)[0]}.csv'
-        csv_path = os.path.join(upload_folder, csv_file_name)
-        pd.DataFrame(csv_data).to_csv(csv_path, index=False)
-
-        logging.info(f"Detection results saved to {csv_path}")
+        # Loading is reported by the registry, so it is kept out of inference_time
+        model = model_registry.get(model_name)
+        with_embeddings = embeddings and supports_embeddings(model)
+        if embeddings and not with_embeddings:
+            logging.info(f"{model_name} has no per-box features; storing no embeddings")
+        start_time = time.time()
+        boxes, scores, label_names, box_embeddings = detect_objects(model, image, image_name, model_name,
+                                                                    with_embeddings)
+
+        detections_file_name = f'{model_name}_detections_{os.path.splitext(image_name)[0]}{DETECTION_STORE_EXTENSION}'
+        detections_path = os.path.join(upload_folder, detections_file_name)
+        write_image_detections(detections_path, boxes, scores, label_names)
+        catalog_detections(detections_path, 'image')
+        write_label_index(detections_path)
+        write_spatial_index(detections_path)
+        if box_embeddings is not None:
+            write_embeddings(detections_path, box_embeddings)
+        elif os.path.exists(embedding_path(detections_path)):
+            # Left by an earlier run; its rows need not match the new detections
+            os.remove(embedding_path(detections_path))
+
+        logging.info(f"Detection results saved to {detections_path}")
 
         end_time = time.time()
         elapsed_time = end_time - start_time
 
         return {
-            'file_name': csv_file_name,
+            'file_name': detections_file_name,
+            'embeddings': box_embeddings is not None,
             'metrics': {
                 'inference_time': elapsed_time,
             },
@@ -112,6 +131,34 @@ def process_model(model_name: str, image: Image.Image, image_name: str) -> Optio
         logging.error(f"Error processing model {model_name}: {e}")
         return None
 
+def process_models_sequential(model_names: List[str], image: Image.Image, image_name: str,
+                              embeddings: bool = False) -> Dict[str, Dict[str, any]]:
+    all_results = {}
+    for model_name in model_names:
+        result = process_model(model_name, image, image_name, embeddings)
+        if result:
+            all_results[model_name] = result
+    return all_results
+
+def process_models_parallel(model_names: List[str], image: Image.Image, image_name: str,
+                            embeddings: bool = False) -> Dict[str, Dict[str, any]]:
+    max_workers = max(1, min(len(model_names), os.cpu_count() or 1))
+    # Every inference path, batched or not, takes its share of the cores from torch_threads while it runs
+    logging.info(f"Running {len(model_names)} models in parallel")
+
+    # Decode once up front so worker threads don't race on PIL's lazy loading
+    image.load()
+
+    all_results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {model_name: executor.submit(process_model, model_name, image, image_name, embeddings)
+                   for model_name in model_names}
+        for model_name, future in futures.items():
+            result = future.result()
+            if result:
+                all_results[model_name] = result
+    return all_results
+
 def init_app(app: Flask) -> None:
     @app.route('/process-image', methods=['POST'])
     def process_image():
@@ -122,11 +169,20 @@ def init_app(app: Flask) -> None:
 
         data = request.get_json()
         image_name = data.get('image_name')
+        parallel = bool(data.get('parallel', False))
+        # Also store an embedding per detection for /similar-objects (R-CNN models only)
+        embeddings = bool(data.get('embeddings', False))
 
         # Validate image_name
         if not image_name:
             return jsonify({'error': 'Image name not provided'}), 400
 
+        # Only the requested models (or profile) are loaded and run
+        try:
+            model_names = resolve_model_names(data.get('models'), data.get('profile'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
         # Construct image file path
         image_path = os.path.join(upload_folder, image_name)
 
@@ -138,14 +194,21 @@ def init_app(app: Flask) -> None:
             image = Image.open(image_path)
             file_name = image_name
 
-            # Process each model
-            all_results = {}
-            for model_name, model_instance in models_dict.items():
-                result = process_model(model_name, image, file_name)
-                if result:
-                    all_results[model_name] = result
+            # Process each selected model
+            start_time = time.time()
+            if parallel:
+                all_results = process_models_parallel(model_names, image, file_name, embeddings)
+            else:
+                all_results = process_models_sequential(model_names, image, file_name, embeddings)
+            total_time = time.time() - start_time
+
             app.logger.info('Image processing complete.')
-            return jsonify({'status': 'success', 'results': all_results})
+            return jsonify({
+                'status': 'success',
+                'results': all_results,
+                'total_time': total_time,
+                'parallel': parallel,
+            })
 
         except Exception as e:
             logging.error(f"Error processing image: {e}")
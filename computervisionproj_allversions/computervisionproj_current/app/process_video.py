@@ -1,31 +1,46 @@
 import cv2
 import os
-import pandas as pd
+import time
 import torch
-from torchvision import models, transforms
+from torchvision import transforms
 from flask import jsonify, request
-from .config import upload_folder
+from .config import (upload_folder, VIDEO_BATCH_SIZE, VIDEO_MAX_BATCH_SIZE, VIDEO_PIPELINE_QUEUE_SIZE,
+                     VIDEO_RENDER_MAX_BUFFERED_FRAMES)
 from .get_coco_categories import get_coco_categories
+from .model_registry import model_registry, resolve_model_names
+from .frame_sampling import parse_sampler, parse_scene_change_gate
+from .tracker import SortTracker
+from .video_pipeline import VideoPipeline
+from .video_shards import process_video_sharded
+from .video_seek import seek_to_frame
+from .detection_writer import DetectionCsvWriter
+from .video_checkpoint import VideoCheckpoint
+from .generate_video import VideoRenderer
+from .label_intervals import write_interval_index
+from .detection_store import convert_csv_to_store
+from .detection_catalog import catalog_detections
+from .label_index import write_label_index
+from .spatial_index import write_spatial_index
 
-# Load the pre-trained Faster R-CNN model
-model = models.detection.fasterrcnn_resnet50_fpn(pretrained=True)
-model.eval()
+# Video detection shares the process-wide registry with /process-image
+VIDEO_MODEL_NAME = 'fasterrcnn'
 
-def detect_objects(frame):
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-    ])
+# Model name of the marker VideoDetector emits once every row up to a frame has been produced
+FRAME_DONE = None
 
-    frame_tensor = transform(frame).unsqueeze(0)
+# Stands in for the pixels of frames the sampler left out, as opposed to None for gated frames
+SKIPPED = object()
 
-    with torch.no_grad():
-        predictions = model(frame_tensor)
+transform = transforms.Compose([
+    transforms.ToTensor(),
+])
 
+def filter_predictions(prediction):
     boxes = []
     scores = []
     labels = []
 
-    for box, score, label in zip(predictions[0]['boxes'], predictions[0]['scores'], predictions[0]['labels']):
+    for box, score, label in zip(prediction['boxes'], prediction['scores'], prediction['labels']):
         if score > 0.8:  # Adjust the threshold as needed
             boxes.append(box.tolist())
             scores.append(score.item())
@@ -33,6 +48,210 @@ def detect_objects(frame):
 
     return boxes, scores, labels
 
+def infer_batch(model, frame_tensors):
+    # Detection models take a list of images and batch them internally in one forward pass
+    with torch.no_grad():
+        predictions = model(frame_tensors)
+
+    return [filter_predictions(prediction) for prediction in predictions]
+
+def detect_objects_batch(model, frames):
+    return infer_batch(model, [transform(frame) for frame in frames])
+
+def detect_objects(model, frame):
+    return detect_objects_batch(model, [frame])[0]
+
+def read_frames(video_capture, sampler=None, include_skipped=False, first_frame_number=0, max_frames=None,
+                on_frame=None):
+    # Frames the sampler drops are either left out or, with include_skipped, yielded as SKIPPED.
+    # first_frame_number keeps numbering global when the capture was seeked to a later segment.
+    # on_frame, if given, receives every decoded frame, sampled or not.
+    frame_number = first_frame_number
+    while video_capture.isOpened():
+        if max_frames is not None and frame_number - first_frame_number >= max_frames:
+            break
+        # grab() advances the stream; only frames the sampler keeps are retrieved and converted
+        if not video_capture.grab():
+            break
+
+        frame_number += 1
+        timestamp = video_capture.get(cv2.CAP_PROP_POS_MSEC)  # Get timestamp in milliseconds
+        frame = None
+        if on_frame is not None:
+            ret, frame = video_capture.retrieve()
+            if not ret:
+                break
+            on_frame(frame_number, timestamp, frame.copy())
+
+        if sampler is not None and not sampler.should_infer(frame_number, timestamp):
+            if include_skipped:
+                yield frame_number, timestamp, SKIPPED
+            continue
+
+        if frame is None:
+            ret, frame = video_capture.retrieve()
+            if not ret:
+                break
+        yield frame_number, timestamp, frame
+
+class BatchSizeTuner:
+    # Doubles the batch size while the per-frame time keeps improving, then settles
+    def __init__(self, batch_size=VIDEO_BATCH_SIZE, max_batch_size=VIDEO_MAX_BATCH_SIZE, auto=False):
+        self.batch_size = 1 if auto else max(1, min(int(batch_size), max_batch_size))
+        self.max_batch_size = max_batch_size
+        self.settled = not auto
+        self._best = None
+
+    def record(self, batch_size, elapsed_time):
+        if self.settled or batch_size == 0 or batch_size != self.batch_size:
+            return
+
+        per_frame_time = elapsed_time / batch_size
+        if self._best is None or per_frame_time < self._best[1] * 0.95:
+            self._best = (batch_size, per_frame_time)
+            if batch_size * 2 <= self.max_batch_size:
+                self.batch_size = batch_size * 2
+                return
+        self.batch_size = self._best[0]
+        self.settled = True
+        print(f"Video batch size tuned to {self.batch_size}")
+
+def parse_batch_size(value):
+    if value is None:
+        return BatchSizeTuner()
+    if value == 'auto':
+        return BatchSizeTuner(auto=True)
+    batch_size = int(value)
+    if batch_size < 1:
+        raise ValueError('batch_size must be a positive integer or "auto"')
+    return BatchSizeTuner(batch_size)
+
+def preprocess_frame(frame_number, timestamp, frame, gate=None):
+    # Frames the scene-change gate rejects lose their pixels and reuse earlier detections
+    if frame is SKIPPED:
+        return frame_number, timestamp, SKIPPED
+    if frame is None or (gate is not None and not gate.should_infer(frame)):
+        return frame_number, timestamp, None
+    return frame_number, timestamp, transform(frame)
+
+def has_pixels(frame_tensor):
+    return frame_tensor is not None and frame_tensor is not SKIPPED
+
+class VideoDetector:
+    """Batches preprocessed frames through the selected models and turns the predictions
+    into (model_name, row) pairs for the CSV writer.
+
+    Frames passed as None (rejected by the scene-change gate) or SKIPPED (left out by
+    the sampler) get no detector call. With tracking their boxes are predicted by a
+    per-model SORT tracker; otherwise gated frames reuse the last detections and
+    skipped frames get no rows.
+
+    After each batch a (FRAME_DONE, frame_number) pair marks that frame as complete.
+    max_buffered_frames forces a partial batch once that many frames are waiting."""
+
+    def __init__(self, selected_models, label_names, tuner, tracking=False, first_track_ids=None,
+                 max_buffered_frames=None):
+        self.selected_models = selected_models
+        self.label_names = label_names
+        self.tuner = tuner
+        first_track_ids = first_track_ids or {}
+        self.trackers = {model_name: SortTracker(first_track_id=first_track_ids.get(model_name, 1))
+                         for model_name in selected_models} if tracking else None
+        self.max_buffered_frames = max_buffered_frames
+        self._last_detections = {}
+        self._batch = []
+        self._pending_frames = 0
+
+    def add_frame(self, frame_number, timestamp, frame_tensor):
+        if has_pixels(frame_tensor):
+            self._pending_frames += 1
+        self._batch.append((frame_number, timestamp, frame_tensor))
+
+        # Frames without pixels can be resolved straight away when nothing is waiting on the detector
+        if (self._pending_frames == 0 or self._pending_frames >= self.tuner.batch_size
+                or (self.max_buffered_frames is not None and len(self._batch) >= self.max_buffered_frames)):
+            return self.flush()
+        return []
+
+    def flush(self):
+        if not self._batch:
+            return []
+        batch = self._batch
+        self._batch = []
+        self._pending_frames = 0
+
+        frame_tensors = [frame_tensor for _, _, frame_tensor in batch if has_pixels(frame_tensor)]
+        rows = []
+        start_time = time.time()
+        for model_name, model in self.selected_models.items():
+            batch_results = iter(infer_batch(model, frame_tensors) if frame_tensors else [])
+            for frame_number, timestamp, frame_tensor in batch:
+                detections = next(batch_results) if has_pixels(frame_tensor) else None
+                rows.extend(self._rows(model_name, frame_number, timestamp, detections, frame_tensor is SKIPPED))
+        self.tuner.record(len(frame_tensors), time.time() - start_time)
+        rows.append((FRAME_DONE, batch[-1][0]))
+        return rows
+
+    def next_track_ids(self):
+        if self.trackers is None:
+            return {}
+        return {model_name: tracker.next_track_id for model_name, tracker in self.trackers.items()}
+
+    def _rows(self, model_name, frame_number, timestamp, detections, skipped):
+        inferred = detections is not None
+
+        if self.trackers is not None:
+            for track_id, box, score, label, source_frame in self.trackers[model_name].step(frame_number, detections):
+                yield self._row(model_name, timestamp, frame_number, label, box, score, inferred, source_frame, track_id)
+            return
+        if skipped:
+            return
+
+        if inferred:
+            self._last_detections[model_name] = (frame_number, detections)
+        source_frame, (boxes, scores, labels) = self._last_detections.get(model_name, (None, ([], [], [])))
+        for box, score, label in zip(boxes, scores, labels):
+            yield self._row(model_name, timestamp, frame_number, label, box, score, inferred, source_frame, None)
+
+    def _row(self, model_name, timestamp, frame_number, label, box, score, inferred, source_frame, track_id):
+        return model_name, {
+            'timestamp': timestamp,
+            'frame': frame_number,
+            'label': self.label_names[label],
+            'bounding_boxes': box,
+            'score': score,
+            'inferred': inferred,
+            'source_frame': source_frame,
+            'track_id': track_id
+        }
+
+def detection_csv_paths(file_name, model_names):
+    # One CSV per selected model, named like the image detection files
+    base_name = os.path.basename(file_name).split(".")[0]
+    return {model_name: os.path.join(upload_folder, f'{model_name}_detections_{base_name}.csv')
+            for model_name in model_names}
+
+def detections_response(csv_paths, model_names, stats, sampling):
+    # The CSVs are only a journal while the video is processed. Once complete they are converted to
+    # the columnar store, cataloged and indexed, so sharded and resumed runs get the same sidecars.
+    # sampling (FrameSampler.describe) is stored with the detections.
+    results = {}
+    for model_name in model_names:
+        detections_path = convert_csv_to_store(csv_paths[model_name], sampling=sampling)
+        catalog_detections(detections_path, 'video')
+        results[model_name] = {'file_name': os.path.basename(detections_path),
+                               'label_index': os.path.basename(write_label_index(detections_path)),
+                               'spatial_index': os.path.basename(write_spatial_index(detections_path)),
+                               'interval_index': os.path.basename(
+                                   write_interval_index(detections_path, sampling['interval_ms']))}
+
+    # Return the CSV paths for further processing
+    return jsonify({
+        'csv_file_name': results[model_names[0]]['file_name'],
+        'results': results,
+        **stats,
+    })
+
 def init_app(app):
     @app.route('/process-video', methods=['POST'])
     def process_video():
@@ -43,6 +262,17 @@ def init_app(app):
         if not file_name:
             return jsonify({'error': 'Missing file_name'}), 400
 
+        # Faster R-CNN only unless the request selects other models or a profile
+        try:
+            model_names = resolve_model_names(data.get('models'), data.get('profile'), [VIDEO_MODEL_NAME])
+            tuner = parse_batch_size(data.get('batch_size'))
+            shards = int(data.get('shards', 1))
+            render = bool(data.get('render', False))
+            if render and shards > 1:
+                raise ValueError('render is not supported together with shards')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
         video_path = os.path.join(upload_folder, file_name)
         print(f"Processing video: {os.path.basename(video_path)}")
 
@@ -50,45 +280,122 @@ def init_app(app):
         if not video_capture.isOpened():
             return jsonify({'error': 'Could not open video'}), 400
 
-        coco_categories = get_coco_categories()
-        label_names = {label_id: label_name for label_id, label_name in coco_categories.items()}
+        # Every frame by default; 'stride', 'fps' and 'keyframes' run the detector on a subset
+        try:
+            sampler = parse_sampler(data, video_path, video_capture.get(cv2.CAP_PROP_FPS))
+            gate = parse_scene_change_gate(data)
+        except ValueError as e:
+            video_capture.release()
+            return jsonify({'error': str(e)}), 400
 
-        data_to_save = []
+        csv_paths = detection_csv_paths(file_name, model_names)
 
-        frame_number = 0
-        while video_capture.isOpened():
-            ret, frame = video_capture.read()
-            if not ret:
-                break
+        # Sharded mode splits the video into time segments processed by separate worker processes
+        if shards > 1:
+            video_capture.release()
+            sharded = process_video_sharded(video_path, model_names, data, shards, csv_paths)
+            print(f"Video processed: {file_name}")
+            return detections_response(csv_paths, model_names, {
+                'batch_size': tuner.batch_size,
+                'sampling': sharded['sampling'],
+                'scene_change': sharded['scene_change'],
+                'tracking': bool(data.get('tracking', False)),
+                'shards': sharded['shards'],
+                'rows_written': sharded['rows_written'],
+            }, sampler.describe(sharded['sampling']['frames_total'], bool(data.get('tracking', False))))
 
-            frame_number += 1
-            timestamp = video_capture.get(cv2.CAP_PROP_POS_MSEC)  # Get timestamp in milliseconds
+        coco_categories = get_coco_categories()
+        label_names = {label_id: label_name for label_id, label_name in coco_categories.items()}
 
-            boxes, scores, labels = detect_objects(frame)
+        selected_models = {model_name: model_registry.get(model_name) for model_name in model_names}
 
-            for box, score, label in zip(boxes, scores, labels):
-                label_name = label_names[label]
-                data_to_save.append({
-                    'timestamp': timestamp,
-                    'frame': frame_number,
-                    'label': label_name,
-                    'bounding_boxes': box,
-                    'score': score
-                })
+        # Pick up an interrupted run of the same job from its last checkpoint unless asked to restart
+        checkpoint = VideoCheckpoint.for_job(video_path, csv_paths, data)
+        if data.get('restart', False) or render:
+            # The annotated video cannot be appended to, so rendering always starts from the first frame
+            checkpoint.clear()
+        state = checkpoint.load()
+        if state is not None and not checkpoint.restore_files(state, csv_paths):
+            state = None
+        start_frame = state['frame'] if state is not None else 0
+        if start_frame:
+            print(f"Resuming {file_name} after frame {start_frame}")
+            # Frames are numbered on from start_frame, so the capture has to land exactly on it
+            seek_to_frame(video_capture, start_frame)
 
-        video_capture.release()
-        print(f"Video processed: {file_name}")
+        # With tracking, frames the sampler skips still get boxes carried over by the tracker
+        tracking = bool(data.get('tracking', False))
+        detector = VideoDetector(selected_models, label_names, tuner, tracking,
+                                 state['next_track_ids'] if state is not None else None,
+                                 VIDEO_RENDER_MAX_BUFFERED_FRAMES if render else None)
 
-        csv_file_name = f'detections_{os.path.basename(file_name).split(".")[0]}.csv'
-        csv_path = os.path.join(upload_folder, csv_file_name)
-        df = pd.DataFrame(data_to_save)
+        # Single-pass mode draws every label of the first selected model while decoding for detection
+        renderer = None
+        if render:
+            renderer = VideoRenderer(os.path.basename(file_name), video_capture.get(cv2.CAP_PROP_FPS),
+                                     int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                                     int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            render_model = model_names[0]
 
+        # Rows are appended to the CSVs in chunks as frames complete instead of being kept in memory
         try:
-            df.to_csv(csv_path, index=False)
-            print(f"CSV file saved at: {csv_path}")
-        except Exception as e:
+            writer = DetectionCsvWriter(csv_paths, append=state is not None)
+        except OSError as e:
+            video_capture.release()
             print(f"Error saving CSV file: {str(e)}")
             return jsonify({'error': 'Failed to save CSV file'}), 500
 
-        # Return the CSV path for further processing
-        return jsonify({'csv_file_name': csv_file_name})
+        def write_row(output):
+            model_name, row = output
+            if model_name is FRAME_DONE:
+                checkpoint.commit(row, writer, detector.next_track_ids())
+                if renderer is not None:
+                    renderer.commit(row)
+            else:
+                writer.write(model_name, row)
+                if renderer is not None and model_name == render_model:
+                    renderer.add_row(row)
+
+        # Rendering needs every frame to pass through the bounded pipeline queues, so skipped ones are kept
+        frames = read_frames(video_capture, sampler, include_skipped=tracking or render,
+                             first_frame_number=start_frame,
+                             on_frame=renderer.add_frame if renderer is not None else None)
+        pipeline_report = None
+        try:
+            if data.get('pipeline', True):
+                # Decode, preprocess, inference and writing overlap in separate stages
+                pipeline = VideoPipeline(
+                    frames,
+                    preprocess=lambda item: preprocess_frame(*item, gate=gate),
+                    infer=lambda item: detector.add_frame(*item),
+                    finish=detector.flush,
+                    write=write_row,
+                    queue_size=int(data.get('pipeline_queue_size', VIDEO_PIPELINE_QUEUE_SIZE)),
+                )
+                pipeline.run()
+                pipeline_report = pipeline.stage_report()
+            else:
+                for frame_number, timestamp, frame in frames:
+                    for output in detector.add_frame(*preprocess_frame(frame_number, timestamp, frame, gate)):
+                        write_row(output)
+                for output in detector.flush():
+                    write_row(output)
+        finally:
+            video_capture.release()
+            writer.close()
+            if renderer is not None:
+                renderer.close()
+        checkpoint.clear()
+        print(f"Video processed: {file_name}")
+
+        return detections_response(csv_paths, model_names, {
+            'batch_size': tuner.batch_size,
+            'sampling': sampler.stats(),
+            'scene_change': gate.stats() if gate is not None else None,
+            'tracking': tracking,
+            'pipeline': pipeline_report,
+            'rows_written': writer.rows_written,
+            'resumed_from_frame': start_frame,
+            'annotated_video_path': (os.path.join('uploads', renderer.annotated_video_filename)
+                                     if renderer is not None else None),
+        }, sampler.describe(start_frame + sampler.frames_seen, tracking))
@@ -1,7 +1,10 @@
+import json
 import os
-import pandas as pd
+import re
 from flask import Blueprint, jsonify, request
 from .config import upload_folder
+from .detection_store import load_detections
+from .label_index import label_indexes
 
 search_annotation_bp = Blueprint('search_annotation', __name__)
 
@@ -14,39 +17,42 @@ def search_annotation():
     if not csv_file_names or not query:
         return jsonify({'error': 'No csv_file_names or query provided'}), 400
 
+    # Same matching as pandas' str.contains: a case-insensitive regex, or the literal text if it is not one
+    try:
+        pattern = re.compile(query, re.IGNORECASE)
+    except re.error:
+        pattern = re.compile(re.escape(query), re.IGNORECASE)
+
     labels_results = []
 
     for csv_file_name in csv_file_names:
-        # Load CSV for the filename
         temp_csv_path = os.path.join(upload_folder, csv_file_name)
-        if not os.path.exists(temp_csv_path):
-            print(f"CSV file not found: {temp_csv_path}")
-            continue
 
         try:
-            # Read CSV and filter based on query
-            df = pd.read_csv(temp_csv_path)
-
-            if 'labels' in df.columns:
-                # Detection file: Extract boxes from 'labels'
-                matched_entries = df[df['labels'].str.contains(query, case=False, na=False)]
-                if not matched_entries.empty:
-                    boxes_data = matched_entries[['labels', 'boxes']].to_dict(orient='records')
-                    labels_results.append({
-                        'filename': csv_file_name,
-                        'boxes_data': boxes_data
-                    })
-
-        except pd.errors.EmptyDataError:
-            print(f"CSV file is empty: {temp_csv_path}")
-            continue
-        except pd.errors.ParserError:
-            print(f"Error parsing CSV file: {temp_csv_path}")
+            index = label_indexes.get(temp_csv_path)
+        except FileNotFoundError:
+            print(f"Detection file not found: {temp_csv_path}")
             continue
         except Exception as e:
             print(f"Error searching annotations in {csv_file_name}: {e}")
             continue
 
+        # The query is matched against the indexed labels; only the rows of matching labels are read
+        matched_rows = index.rows_for([label for label in index.label_names if pattern.search(label)])
+        if len(matched_rows):
+            table = load_detections(temp_csv_path)
+            boxes_data = [{'labels': label, 'boxes': json.dumps(box)}
+                          for label, box in zip(table.labels(matched_rows), table.boxes[matched_rows].tolist())]
+            if table.is_video:
+                for entry, frame, timestamp in zip(boxes_data, table.columns['frame'][matched_rows].tolist(),
+                                                   table.columns['timestamp'][matched_rows].tolist()):
+                    entry['frame'] = frame
+                    entry['timestamp'] = timestamp
+            labels_results.append({
+                'filename': csv_file_name,
+                'boxes_data': boxes_data
+            })
+
     if not labels_results:
         return jsonify({'error': f'The annotation "{query}" is not available in the provided files.'}), 404
 
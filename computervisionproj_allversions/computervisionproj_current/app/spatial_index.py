@@ -0,0 +1,258 @@
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from flask import jsonify, request
+from .config import upload_folder, SPATIAL_GRID_CELL_PX
+from .detection_store import DetectionTable, FileCache, atomic_savez, load_detections, load_npz, store_path
+
+SPATIAL_OPERATIONS = ('intersects', 'contains', 'nearest', 'area')
+
+
+def spatial_index_path(detections_path: str) -> str:
+    return f'{os.path.splitext(store_path(detections_path))[0]}.grid.npz'
+
+
+def build_spatial_index(table: DetectionTable, cell_size: int = SPATIAL_GRID_CELL_PX) -> Dict[str, np.ndarray]:
+    # Every box is listed in each grid cell it overlaps. Keys are cell * frame_span + frame, so the
+    # rows of one cell are contiguous across frames and a frame range is a single slice per cell.
+    boxes = table.boxes
+    count = len(table)
+    frames = table.columns['frame'].astype(np.int64) if table.is_video else np.zeros(count, dtype=np.int64)
+    frame_span = int(frames.max()) + 1 if count else 1
+
+    cell_x1 = np.clip(np.floor(boxes[:, 0] / cell_size), 0, None).astype(np.int64)
+    cell_y1 = np.clip(np.floor(boxes[:, 1] / cell_size), 0, None).astype(np.int64)
+    cell_x2 = np.maximum(np.floor(boxes[:, 2] / cell_size).astype(np.int64), cell_x1)
+    cell_y2 = np.maximum(np.floor(boxes[:, 3] / cell_size).astype(np.int64), cell_y1)
+    grid_width = int(cell_x2.max()) + 1 if count else 1
+    grid_height = int(cell_y2.max()) + 1 if count else 1
+
+    cells_x = cell_x2 - cell_x1 + 1
+    cells_per_box = cells_x * (cell_y2 - cell_y1 + 1)
+    rows = np.repeat(np.arange(count, dtype=np.int64), cells_per_box)
+    local = np.arange(len(rows), dtype=np.int64) - np.repeat(np.cumsum(cells_per_box) - cells_per_box, cells_per_box)
+    cells = (cell_y1[rows] + local // cells_x[rows]) * grid_width + cell_x1[rows] + local % cells_x[rows]
+    keys = cells * frame_span + frames[rows]
+
+    order = np.argsort(keys, kind='stable')
+    unique_keys, starts = np.unique(keys[order], return_index=True)
+
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    area_order = np.argsort(areas, kind='stable')
+    return {
+        'shape': np.array([cell_size, grid_width, grid_height, frame_span], dtype=np.int64),
+        'keys': unique_keys,
+        'pointers': np.append(starts, len(order)).astype(np.int64),
+        'offsets': rows[order],
+        'area_order': area_order.astype(np.int64),
+        'sorted_areas': areas[area_order].astype(np.float32),
+    }
+
+
+def write_spatial_index(detections_path: str) -> str:
+    start_time = time.time()
+    arrays = build_spatial_index(load_detections(detections_path))
+    index_path = spatial_index_path(detections_path)
+    spatial_indexes.evict(index_path)
+    atomic_savez(index_path, **arrays)
+    logging.info(f"Built {len(arrays['keys'])}-cell spatial index of {detections_path} "
+                 f"in {time.time() - start_time:.3f}s")
+    return index_path
+
+
+class SpatialIndex:
+    """Uniform grid over the boxes of one detection file, plus the rows sorted by box area.
+
+    Queries only visit the grid cells they cover, then test the candidate boxes exactly."""
+
+    def __init__(self, table: DetectionTable, arrays: Dict[str, np.ndarray]):
+        self.table = table
+        self.cell_size, self.grid_width, self.grid_height, self.frame_span = arrays['shape'].tolist()
+        self.keys = arrays['keys']
+        self.pointers = arrays['pointers']
+        self.offsets = arrays['offsets']
+        self.area_order = arrays['area_order']
+        self.sorted_areas = arrays['sorted_areas']
+
+    def _frame_range(self, frames: Optional[Tuple[int, int]]) -> Tuple[int, int]:
+        if frames is None:
+            return 0, self.frame_span - 1
+        return max(0, frames[0]), min(self.frame_span - 1, frames[1])
+
+    def _cell_rows(self, cells: np.ndarray, frames: Optional[Tuple[int, int]]) -> np.ndarray:
+        first_frame, last_frame = self._frame_range(frames)
+        if not len(cells) or first_frame > last_frame:
+            return np.empty(0, dtype=np.int64)
+        lo = np.searchsorted(self.keys, cells * self.frame_span + first_frame, 'left')
+        hi = np.searchsorted(self.keys, cells * self.frame_span + last_frame, 'right')
+        slices = [self.offsets[self.pointers[start]:self.pointers[end]] for start, end in zip(lo, hi) if end > start]
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        # A box spanning several cells is found once per cell
+        return np.unique(np.concatenate(slices))
+
+    def _cells_in(self, region) -> np.ndarray:
+        x1, y1, x2, y2 = region
+        cell_x1 = max(0, int(x1 // self.cell_size))
+        cell_y1 = max(0, int(y1 // self.cell_size))
+        cell_x2 = min(self.grid_width - 1, int(x2 // self.cell_size))
+        cell_y2 = min(self.grid_height - 1, int(y2 // self.cell_size))
+        if cell_x1 > cell_x2 or cell_y1 > cell_y2:
+            return np.empty(0, dtype=np.int64)
+        cell_ys, cell_xs = np.mgrid[cell_y1:cell_y2 + 1, cell_x1:cell_x2 + 1]
+        return (cell_ys * self.grid_width + cell_xs).ravel().astype(np.int64)
+
+    def intersects(self, region, frames=None) -> np.ndarray:
+        rows = self._cell_rows(self._cells_in(region), frames)
+        boxes = self.table.boxes[rows]
+        x1, y1, x2, y2 = region
+        hit = (boxes[:, 0] <= x2) & (boxes[:, 2] >= x1) & (boxes[:, 1] <= y2) & (boxes[:, 3] >= y1)
+        return rows[hit]
+
+    def contains(self, region, frames=None) -> np.ndarray:
+        # Boxes lying entirely inside the region
+        rows = self._cell_rows(self._cells_in(region), frames)
+        boxes = self.table.boxes[rows]
+        x1, y1, x2, y2 = region
+        inside = (boxes[:, 0] >= x1) & (boxes[:, 1] >= y1) & (boxes[:, 2] <= x2) & (boxes[:, 3] <= y2)
+        return rows[inside]
+
+    def area(self, min_area=None, max_area=None, frames=None) -> np.ndarray:
+        lo = np.searchsorted(self.sorted_areas, min_area, 'left') if min_area is not None else 0
+        hi = np.searchsorted(self.sorted_areas, max_area, 'right') if max_area is not None else len(self.sorted_areas)
+        rows = np.sort(self.area_order[lo:hi])
+        if frames is not None and self.table.is_video:
+            frame_values = self.table.columns['frame'][rows]
+            rows = rows[(frame_values >= frames[0]) & (frame_values <= frames[1])]
+        return rows
+
+    def nearest(self, point, k: int = 1, frames=None) -> Tuple[np.ndarray, np.ndarray]:
+        # Grid rings around the point are searched outwards. A box at distance d overlaps a cell
+        # within ring ceil(d / cell_size), so the search stops once the k-th best is that close.
+        px, py = point
+        center_x, center_y = int(px // self.cell_size), int(py // self.cell_size)
+        max_ring = max(center_x, self.grid_width - 1 - center_x, center_y, self.grid_height - 1 - center_y, 0)
+        seen = np.empty(0, dtype=np.int64)
+        distances = np.empty(0, dtype=np.float32)
+        for ring in range(max_ring + 1):
+            ring_cells = [(x, y) for y in range(center_y - ring, center_y + ring + 1)
+                          for x in range(center_x - ring, center_x + ring + 1)
+                          if max(abs(x - center_x), abs(y - center_y)) == ring
+                          and 0 <= x < self.grid_width and 0 <= y < self.grid_height]
+            cells = np.array([y * self.grid_width + x for x, y in ring_cells], dtype=np.int64)
+            rows = np.setdiff1d(self._cell_rows(cells, frames), seen, assume_unique=True)
+            if len(rows):
+                boxes = self.table.boxes[rows]
+                dx = np.maximum(np.maximum(boxes[:, 0] - px, px - boxes[:, 2]), 0)
+                dy = np.maximum(np.maximum(boxes[:, 1] - py, py - boxes[:, 3]), 0)
+                seen = np.concatenate((seen, rows))
+                distances = np.concatenate((distances, np.hypot(dx, dy)))
+            if len(seen) >= k and np.sort(distances)[k - 1] <= ring * self.cell_size:
+                break
+        best = np.argsort(distances, kind='stable')[:k]
+        return seen[best], distances[best]
+
+
+class SpatialIndexCache(FileCache):
+    """Keeps loaded spatial indexes, keyed by path and mtime."""
+
+    def get(self, detections_path: str) -> SpatialIndex:
+        table = load_detections(detections_path)
+        index_path = spatial_index_path(table.path)
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(table.path):
+            write_spatial_index(table.path)
+        mtime = os.path.getmtime(index_path)
+
+        index = self.lookup(index_path, mtime)
+        if index is not None and index.table is table:
+            return index
+        index = SpatialIndex(table, load_npz(index_path))
+        self.store(index_path, mtime, index)
+        return index
+
+
+spatial_indexes = SpatialIndexCache()
+
+
+def parse_box(value, name: str):
+    if not isinstance(value, (list, tuple)) or len(value) != 4:
+        raise ValueError(f'{name} must be a list of four numbers')
+    return [float(coordinate) for coordinate in value]
+
+
+def init_app(app):
+    @app.route('/spatial-query', methods=['POST'])
+    def spatial_query():
+        data = request.json or {}
+        csv_file_name = data.get('csv_file_name')
+        operation = data.get('op')
+
+        if not csv_file_name:
+            return jsonify({'error': 'No csv_file_name provided'}), 400
+        if operation not in SPATIAL_OPERATIONS:
+            return jsonify({'error': f"Unknown op '{operation}', expected one of {list(SPATIAL_OPERATIONS)}"}), 400
+
+        try:
+            index = spatial_indexes.get(os.path.join(upload_folder, os.path.basename(csv_file_name)))
+        except FileNotFoundError as e:
+            return jsonify({'error': str(e)}), 404
+
+        start_time = time.time()
+        distances = None
+        try:
+            frames = None
+            if data.get('frame') is not None:
+                frames = (int(data['frame']), int(data['frame']))
+            elif data.get('frame_from') is not None or data.get('frame_to') is not None:
+                frames = (int(data.get('frame_from', 0)), int(data.get('frame_to', index.frame_span - 1)))
+            min_area = float(data['min_area']) if data.get('min_area') is not None else None
+            max_area = float(data['max_area']) if data.get('max_area') is not None else None
+
+            if operation == 'intersects':
+                rows = index.intersects(parse_box(data.get('region'), 'region'), frames)
+            elif operation == 'contains':
+                rows = index.contains(parse_box(data.get('region'), 'region'), frames)
+            elif operation == 'area':
+                rows = index.area(min_area, max_area, frames)
+            else:
+                point = data.get('point')
+                if not isinstance(point, (list, tuple)) or len(point) != 2:
+                    raise ValueError('point must be a list of two numbers')
+                rows, distances = index.nearest([float(value) for value in point], max(1, int(data.get('k', 1))),
+                                                frames)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid spatial query: {e}'}), 400
+
+        # Area and label filters narrow the region and nearest-neighbour results
+        table = index.table
+        keep = np.ones(len(rows), dtype=bool)
+        if operation != 'area' and (min_area is not None or max_area is not None):
+            boxes = table.boxes[rows]
+            areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+            if min_area is not None:
+                keep &= areas >= min_area
+            if max_area is not None:
+                keep &= areas <= max_area
+        if data.get('labels'):
+            labels = set(data['labels'])
+            keep &= table.label_mask(lambda name: name in labels)[rows]
+        rows = rows[keep]
+        if distances is not None:
+            distances = distances[keep]
+
+        limit = int(data.get('limit', 1000))
+        matches = [{'row': row, 'label': label, 'boxes': box, 'score': score}
+                   for row, label, box, score in zip(rows[:limit].tolist(), table.labels(rows[:limit]),
+                                                     table.boxes[rows[:limit]].tolist(),
+                                                     table.scores[rows[:limit]].tolist())]
+        if table.is_video:
+            for match, frame in zip(matches, table.columns['frame'][rows[:limit]].tolist()):
+                match['frame'] = frame
+        if distances is not None:
+            for match, distance in zip(matches, distances[:limit].tolist()):
+                match['distance'] = distance
+
+        return jsonify({'matches': matches, 'count': len(rows), 'query_time': time.time() - start_time}), 200
@@ -0,0 +1,148 @@
+import numpy as np
+from typing import List, Optional, Tuple
+from .config import TRACKER_IOU_THRESHOLD, TRACKER_MAX_AGE
+
+
+def box_to_state(box) -> np.ndarray:
+    # [x1, y1, x2, y2] -> [cx, cy, area, aspect ratio]
+    width = box[2] - box[0]
+    height = box[3] - box[1]
+    return np.array([box[0] + width / 2.0, box[1] + height / 2.0, width * height,
+                     width / float(height) if height else 0.0]).reshape((4, 1))
+
+
+def state_to_box(state) -> List[float]:
+    # Plain floats: the box is written to CSV as its repr, where np.float64 would leak into the text
+    center_x, center_y, area, ratio = np.asarray(state, dtype=np.float64).reshape(-1)[:4].tolist()
+    area = max(area, 0.0)
+    ratio = max(ratio, 0.0)
+    width = (area * ratio) ** 0.5
+    height = area / width if width else 0.0
+    return [center_x - width / 2.0, center_y - height / 2.0, center_x + width / 2.0, center_y + height / 2.0]
+
+
+def iou_matrix(boxes_a, boxes_b) -> np.ndarray:
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0.0)
+
+
+class KalmanBoxTrack:
+    """Constant-velocity Kalman filter over box centre, area and aspect ratio (as in SORT)."""
+
+    def __init__(self, track_id: int, box, score: float, label, frame_number: int):
+        self.track_id = track_id
+        self.score = score
+        self.label = label
+        self.last_frame = frame_number
+        self.missed_updates = 0
+
+        self.F = np.eye(7)
+        self.F[0, 4] = self.F[1, 5] = self.F[2, 6] = 1.0
+        self.H = np.eye(4, 7)
+        self.R = np.eye(4)
+        self.R[2:, 2:] *= 10.0
+        self.P = np.eye(7) * 10.0
+        self.P[4:, 4:] *= 1000.0  # Velocities are unknown at the start
+        self.Q = np.eye(7)
+        self.Q[-1, -1] *= 0.01
+        self.Q[4:, 4:] *= 0.01
+        self.x = np.zeros((7, 1))
+        self.x[:4] = box_to_state(box)
+
+    def predict(self) -> List[float]:
+        if self.x[6, 0] + self.x[2, 0] <= 0:
+            self.x[6, 0] = 0.0
+        self.x = self.F @ self.x
+        self.P = self.F @ self.P @ self.F.T + self.Q
+        return self.box()
+
+    def update(self, box, score: float, frame_number: int) -> None:
+        residual = box_to_state(box) - self.H @ self.x
+        S = self.H @ self.P @ self.H.T + self.R
+        K = self.P @ self.H.T @ np.linalg.inv(S)
+        self.x = self.x + K @ residual
+        self.P = (np.eye(7) - K @ self.H) @ self.P
+        self.score = score
+        self.last_frame = frame_number
+        self.missed_updates = 0
+
+    def box(self) -> List[float]:
+        return state_to_box(self.x[:4])
+
+
+class SortTracker:
+    """Carries detections across frames the detector did not run on.
+
+    step() is called once per frame. On inferred frames detections are matched to the
+    predicted tracks by IoU (same label only) and every detection comes back with a
+    track_id. On other frames the tracks are only predicted forward. A track is
+    dropped after max_age detector runs without a match."""
+
+    def __init__(self, iou_threshold: float = TRACKER_IOU_THRESHOLD, max_age: int = TRACKER_MAX_AGE,
+                 first_track_id: int = 1):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.tracks: List[KalmanBoxTrack] = []
+        self.next_track_id = first_track_id
+
+    def step(self, frame_number: int, detections: Optional[Tuple[list, list, list]] = None) -> List[tuple]:
+        predicted_boxes = [track.predict() for track in self.tracks]
+
+        if detections is None:
+            # Only tracks confirmed by the latest detector run are propagated
+            return [(track.track_id, box, track.score, track.label, track.last_frame)
+                    for track, box in zip(self.tracks, predicted_boxes) if track.missed_updates == 0]
+
+        boxes, scores, labels = detections
+        matches = self._match(predicted_boxes, boxes, labels)
+
+        results = []
+        matched_tracks = set()
+        for index, (box, score, label) in enumerate(zip(boxes, scores, labels)):
+            track = matches.get(index)
+            if track is None:
+                track = KalmanBoxTrack(self.next_track_id, box, score, label, frame_number)
+                self.next_track_id += 1
+                self.tracks.append(track)
+            else:
+                track.update(box, score, frame_number)
+            matched_tracks.add(track.track_id)
+            results.append((track.track_id, box, score, label, frame_number))
+
+        for track in self.tracks:
+            if track.track_id not in matched_tracks:
+                track.missed_updates += 1
+        self.tracks = [track for track in self.tracks if track.missed_updates < self.max_age]
+        return results
+
+    def _match(self, predicted_boxes, boxes, labels) -> dict:
+        if not predicted_boxes or not boxes:
+            return {}
+
+        ious = iou_matrix(boxes, predicted_boxes)
+        # Greedy assignment by descending IoU, restricted to the same label
+        for track_index, track in enumerate(self.tracks):
+            for detection_index, label in enumerate(labels):
+                if label != track.label:
+                    ious[detection_index, track_index] = 0.0
+
+        matches = {}
+        used_tracks = set()
+        for flat_index in np.argsort(-ious, axis=None):
+            detection_index, track_index = np.unravel_index(flat_index, ious.shape)
+            if ious[detection_index, track_index] < self.iou_threshold:
+                break
+            if detection_index in matches or track_index in used_tracks:
+                continue
+            matches[int(detection_index)] = self.tracks[track_index]
+            used_tracks.add(track_index)
+        return matches
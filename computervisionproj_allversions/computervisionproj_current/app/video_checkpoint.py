@@ -0,0 +1,84 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, Optional
+from .config import VIDEO_CHECKPOINT_SECONDS
+
+# Request fields that change the detection output; a checkpoint only resumes the same job
+JOB_OPTION_FIELDS = ('models', 'profile', 'sampling', 'frame_stride', 'target_fps', 'scene_change',
+                     'scene_change_threshold', 'tracking')
+
+
+class VideoCheckpoint:
+    """Records the last fully written frame of a /process-video job and the CSV sizes at
+    that point, so a restarted job can drop any rows past it and continue from there."""
+
+    def __init__(self, path: str, signature: str, interval: float = VIDEO_CHECKPOINT_SECONDS):
+        self.path = path
+        self.signature = signature
+        self.interval = interval
+        self._last_save = time.time()
+
+    @classmethod
+    def for_job(cls, video_path: str, csv_paths: Dict[str, str], options: dict) -> 'VideoCheckpoint':
+        video_stat = os.stat(video_path)
+        job = {
+            'video': os.path.basename(video_path),
+            'video_size': video_stat.st_size,
+            'video_mtime': video_stat.st_mtime,
+            'csv_files': sorted(os.path.basename(path) for path in csv_paths.values()),
+            'options': {field: options.get(field) for field in JOB_OPTION_FIELDS},
+        }
+        signature = hashlib.sha1(json.dumps(job, sort_keys=True).encode('utf-8')).hexdigest()
+        base_name = os.path.splitext(video_path)[0]
+        return cls(f'{base_name}.checkpoint.json', signature)
+
+    def load(self) -> Optional[dict]:
+        try:
+            with open(self.path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+        except (OSError, ValueError):
+            return None
+
+        if state.get('signature') != self.signature:
+            logging.info(f"Ignoring checkpoint {self.path} written for a different job")
+            return None
+        return state
+
+    def restore_files(self, state: dict, csv_paths: Dict[str, str]) -> bool:
+        # Cut every CSV back to its size at the checkpoint, dropping rows of uncommitted frames
+        for model_name, path in csv_paths.items():
+            offset = state['offsets'].get(model_name)
+            if offset is None or not os.path.exists(path) or os.path.getsize(path) < offset:
+                logging.warning(f"Checkpoint {self.path} does not match {path}; starting over")
+                return False
+        for model_name, path in csv_paths.items():
+            with open(path, 'r+b') as detection_file:
+                detection_file.truncate(state['offsets'][model_name])
+        return True
+
+    def commit(self, frame_number: int, writer, next_track_ids: Optional[Dict[str, int]] = None,
+               force: bool = False) -> None:
+        # Called once every row up to frame_number has been handed to the writer
+        if not force and time.time() - self._last_save < self.interval:
+            return
+
+        writer.flush()
+        state = {
+            'signature': self.signature,
+            'frame': frame_number,
+            'offsets': writer.offsets(),
+            'next_track_ids': next_track_ids or {},
+            'saved_at': time.time(),
+        }
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(temp_path, self.path)
+        self._last_save = time.time()
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,180 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable
+from .config import VIDEO_PIPELINE_QUEUE_SIZE
+
+_END = object()
+
+
+class StageStats:
+    def __init__(self):
+        self.items = 0
+        self.busy_time = 0.0     # Time spent doing the stage's own work
+        self.wait_time = 0.0     # Time spent waiting for input from the previous stage
+        self.blocked_time = 0.0  # Time spent blocked on a full output queue (backpressure)
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            'items': self.items,
+            'busy_time': self.busy_time,
+            'wait_time': self.wait_time,
+            'blocked_time': self.blocked_time,
+        }
+
+
+class VideoPipeline:
+    """Runs decode, preprocess, inference and write stages in their own threads.
+
+    Stages are connected by bounded queues, so a slow stage blocks the one feeding it
+    instead of letting frames pile up in memory. OpenCV decoding and torch inference
+    both release the GIL, which lets decoding of the next frames overlap inference.
+
+    decode:     iterable of decoded frame items
+    preprocess: item -> prepared item
+    infer:      prepared item -> list of outputs
+    finish:     () -> list of outputs, called once after the last item to flush partial batches
+    write:      output -> None
+    """
+
+    STAGES = ('decode', 'preprocess', 'inference', 'write')
+
+    def __init__(self, decode: Iterable, preprocess: Callable, infer: Callable, finish: Callable,
+                 write: Callable, queue_size: int = VIDEO_PIPELINE_QUEUE_SIZE):
+        self._decode = decode
+        self._preprocess = preprocess
+        self._infer = infer
+        self._finish = finish
+        self._write = write
+        self._queue_size = max(1, queue_size)
+        self._stop = threading.Event()
+        self._error = None
+        self.stats = {stage: StageStats() for stage in self.STAGES}
+        self.total_time = 0.0
+
+    def run(self) -> None:
+        decoded = queue.Queue(maxsize=self._queue_size)
+        prepared = queue.Queue(maxsize=self._queue_size)
+        # Rows are small, so the writer gets more slack than the frame queues
+        outputs = queue.Queue(maxsize=self._queue_size * 64)
+
+        threads = [
+            threading.Thread(target=self._guard, args=('decode', self._run_decode, decoded), daemon=True),
+            threading.Thread(target=self._guard, args=('preprocess', self._run_preprocess, decoded, prepared),
+                             daemon=True),
+            threading.Thread(target=self._guard, args=('inference', self._run_inference, prepared, outputs),
+                             daemon=True),
+            threading.Thread(target=self._guard, args=('write', self._run_write, outputs), daemon=True),
+        ]
+
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.total_time = time.time() - start_time
+
+        if self._error is not None:
+            raise self._error
+
+    def stage_report(self) -> Dict[str, Dict[str, float]]:
+        return {
+            'total_time': self.total_time,
+            'stages': {stage: stats.as_dict() for stage, stats in self.stats.items()},
+        }
+
+    def _guard(self, stage: str, target: Callable, *queues) -> None:
+        try:
+            target(*queues)
+        except Exception as e:
+            logging.error(f"Video pipeline stage {stage} failed: {e}")
+            if self._error is None:
+                self._error = e
+            self._stop.set()
+
+    def _put(self, stage: str, output_queue: queue.Queue, item) -> None:
+        start_time = time.time()
+        while not self._stop.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.stats[stage].blocked_time += time.time() - start_time
+
+    def _get(self, stage: str, input_queue: queue.Queue):
+        start_time = time.time()
+        item = _END
+        while not self._stop.is_set():
+            try:
+                item = input_queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        self.stats[stage].wait_time += time.time() - start_time
+        return item
+
+    def _run_decode(self, decoded: queue.Queue) -> None:
+        stats = self.stats['decode']
+        frames = iter(self._decode)
+        try:
+            while not self._stop.is_set():
+                start_time = time.time()
+                item = next(frames, _END)
+                stats.busy_time += time.time() - start_time
+                if item is _END:
+                    break
+                stats.items += 1
+                self._put('decode', decoded, item)
+        finally:
+            self._put('decode', decoded, _END)
+
+    def _run_preprocess(self, decoded: queue.Queue, prepared: queue.Queue) -> None:
+        stats = self.stats['preprocess']
+        try:
+            while True:
+                item = self._get('preprocess', decoded)
+                if item is _END:
+                    break
+                start_time = time.time()
+                prepared_item = self._preprocess(item)
+                stats.busy_time += time.time() - start_time
+                stats.items += 1
+                self._put('preprocess', prepared, prepared_item)
+        finally:
+            self._put('preprocess', prepared, _END)
+
+    def _run_inference(self, prepared: queue.Queue, outputs: queue.Queue) -> None:
+        stats = self.stats['inference']
+        try:
+            while True:
+                item = self._get('inference', prepared)
+                if item is _END:
+                    break
+                start_time = time.time()
+                results = self._infer(item)
+                stats.busy_time += time.time() - start_time
+                stats.items += 1
+                for result in results:
+                    self._put('inference', outputs, result)
+
+            if not self._stop.is_set():
+                start_time = time.time()
+                results = self._finish()
+                stats.busy_time += time.time() - start_time
+                for result in results:
+                    self._put('inference', outputs, result)
+        finally:
+            self._put('inference', outputs, _END)
+
+    def _run_write(self, outputs: queue.Queue) -> None:
+        stats = self.stats['write']
+        while True:
+            item = self._get('write', outputs)
+            if item is _END:
+                break
+            start_time = time.time()
+            self._write(item)
+            stats.busy_time += time.time() - start_time
+            stats.items += 1
@@ -0,0 +1,22 @@
+import cv2
+
+# How far before an inexact seek target to retry first; doubled on every further miss
+SEEK_BACK_OFF_FRAMES = 32
+
+
+def seek_to_frame(video_capture, frame_number, back_off=SEEK_BACK_OFF_FRAMES):
+    # Some codecs land on a nearby keyframe instead of the requested frame. Seek to ever earlier points until the
+    # capture lands at or before the frame, then grab forward to it, so only the frames since that point are decoded.
+    if frame_number <= 0:
+        return
+    target = frame_number
+    while True:
+        video_capture.set(cv2.CAP_PROP_POS_FRAMES, target)
+        position = int(video_capture.get(cv2.CAP_PROP_POS_FRAMES))
+        if 0 <= position <= frame_number or target == 0:
+            break
+        target = max(0, frame_number - back_off)
+        back_off *= 2
+    position = max(0, min(position, frame_number))
+    while position < frame_number and video_capture.grab():
+        position += 1
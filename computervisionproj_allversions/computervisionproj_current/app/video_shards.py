@@ -0,0 +1,158 @@
+import csv
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import cv2
+import torch
+from .config import VIDEO_SHARD_WORKERS
+from .detection_writer import DetectionCsvWriter, VIDEO_DETECTION_COLUMNS
+from .video_seek import seek_to_frame
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_shard_pool() -> ProcessPoolExecutor:
+    # One long-lived pool per server process so each worker loads its models only once.
+    # Workers are spawned rather than forked; forking a process that already runs torch threads can deadlock.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=VIDEO_SHARD_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'))
+            logging.info(f"Started video shard pool with {VIDEO_SHARD_WORKERS} workers")
+        return _pool
+
+
+def split_segments(frame_count: int, shards: int) -> List[Tuple[int, int]]:
+    # [start, end) frame offsets; the last segment is open-ended because frame counts are estimates
+    if frame_count <= 0 or shards <= 1:
+        return [(0, None)]
+    shards = min(shards, frame_count)
+    size = -(-frame_count // shards)
+    segments = [(start, start + size) for start in range(0, frame_count, size)]
+    segments[-1] = (segments[-1][0], None)
+    return segments
+
+
+def process_segment(video_path: str, model_names: List[str], options: dict, start_frame: int, end_frame,
+                    num_threads: int, part_paths: Dict[str, str]) -> dict:
+    # Runs in a worker process, with its own copy of the registry and models.
+    # Rows are streamed to per-segment part files that the parent stitches together.
+    from .frame_sampling import parse_sampler, parse_scene_change_gate
+    from .get_coco_categories import get_coco_categories
+    from .model_registry import model_registry
+    from .process_video import FRAME_DONE, VideoDetector, parse_batch_size, preprocess_frame, read_frames
+
+    torch.set_num_threads(num_threads)
+    start_time = time.time()
+
+    video_capture = cv2.VideoCapture(video_path)
+    if not video_capture.isOpened():
+        raise IOError(f"Could not open video {video_path}")
+
+    try:
+        # CAP_PROP_POS_FRAMES alone may land on a nearby keyframe, which would shift the global frame numbers
+        seek_to_frame(video_capture, start_frame)
+
+        sampler = parse_sampler(options, video_path, video_capture.get(cv2.CAP_PROP_FPS))
+        gate = parse_scene_change_gate(options)
+        tracking = bool(options.get('tracking', False))
+        selected_models = {model_name: model_registry.get(model_name) for model_name in model_names}
+        detector = VideoDetector(selected_models, get_coco_categories(), parse_batch_size(options.get('batch_size')),
+                                 tracking)
+
+        frame_count = None if end_frame is None else end_frame - start_frame
+        with DetectionCsvWriter(part_paths) as writer:
+            for frame_number, timestamp, frame in read_frames(video_capture, sampler, include_skipped=tracking,
+                                                              first_frame_number=start_frame, max_frames=frame_count):
+                for model_name, row in detector.add_frame(*preprocess_frame(frame_number, timestamp, frame, gate)):
+                    if model_name is not FRAME_DONE:
+                        writer.write(model_name, row)
+            for model_name, row in detector.flush():
+                if model_name is not FRAME_DONE:
+                    writer.write(model_name, row)
+    finally:
+        video_capture.release()
+
+    return {
+        'start_frame': start_frame,
+        'end_frame': end_frame,
+        'part_paths': part_paths,
+        'sampling': sampler.stats(),
+        'scene_change': gate.stats() if gate is not None else None,
+        'elapsed_time': time.time() - start_time,
+    }
+
+
+def merge_segments(segment_results: List[dict], csv_paths: Dict[str, str]) -> Dict[str, int]:
+    # Segments come back in frame order, so appending their part files keeps rows ordered by frame.
+    # Track ids restart in every segment and are renumbered to stay unique.
+    track_column = VIDEO_DETECTION_COLUMNS.index('track_id')
+    with DetectionCsvWriter(csv_paths) as writer:
+        for model_name in csv_paths:
+            next_track_id = 1
+            for segment in segment_results:
+                part_path = segment['part_paths'][model_name]
+                track_ids = {}
+                with open(part_path, newline='') as part_file:
+                    reader = csv.reader(part_file)
+                    next(reader, None)  # Header
+                    for values in reader:
+                        if values[track_column]:
+                            if values[track_column] not in track_ids:
+                                track_ids[values[track_column]] = next_track_id
+                                next_track_id += 1
+                            values[track_column] = track_ids[values[track_column]]
+                        writer.write_raw(model_name, values)
+                os.remove(part_path)
+    return writer.rows_written
+
+
+def sum_stats(stats_list: List[dict]) -> dict:
+    stats_list = [stats for stats in stats_list if stats]
+    if not stats_list:
+        return None
+    summed = dict(stats_list[0])
+    for stats in stats_list[1:]:
+        for key, value in stats.items():
+            if isinstance(value, int) and not isinstance(value, bool):
+                summed[key] += value
+    return summed
+
+
+def process_video_sharded(video_path: str, model_names: List[str], options: dict, shards: int,
+                          csv_paths: Dict[str, str]) -> dict:
+    video_capture = cv2.VideoCapture(video_path)
+    frame_count = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    video_capture.release()
+
+    shards = max(1, min(shards, VIDEO_SHARD_WORKERS))
+    segments = split_segments(frame_count, shards)
+    # Split the cores between the segments running at the same time
+    num_threads = max(1, (os.cpu_count() or 1) // len(segments))
+    logging.info(f"Processing {video_path} in {len(segments)} segments with {num_threads} threads each")
+
+    pool = get_shard_pool()
+    futures = []
+    for index, (start_frame, end_frame) in enumerate(segments):
+        part_paths = {model_name: f'{path}.part{index}' for model_name, path in csv_paths.items()}
+        futures.append(pool.submit(process_segment, video_path, model_names, options, start_frame, end_frame,
+                                   num_threads, part_paths))
+    segment_results = [future.result() for future in futures]
+
+    return {
+        'rows_written': merge_segments(segment_results, csv_paths),
+        'sampling': sum_stats([segment['sampling'] for segment in segment_results]),
+        'scene_change': sum_stats([segment['scene_change'] for segment in segment_results]),
+        'shards': {
+            'segments': [{'start_frame': segment['start_frame'], 'end_frame': segment['end_frame'],
+                          'elapsed_time': segment['elapsed_time']} for segment in segment_results],
+            'workers': VIDEO_SHARD_WORKERS,
+        },
+    }
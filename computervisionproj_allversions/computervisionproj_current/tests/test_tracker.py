@@ -0,0 +1,69 @@
+import numpy as np
+
+from app import detection_store
+from app.detection_store import convert_csv_to_store, read_detections
+from app.detection_writer import DetectionCsvWriter
+from app.tracker import KalmanBoxTrack, SortTracker
+
+
+def test_predicted_box_is_plain_floats():
+    track = KalmanBoxTrack(1, [10.0, 20.0, 50.0, 100.0], 0.9, 'person', 1)
+    box = track.predict()
+    assert all(type(value) is float for value in box)
+    assert np.allclose(box, [10.0, 20.0, 50.0, 100.0])
+
+
+def test_predicted_frame_round_trips_through_writer_and_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(detection_store, 'get_coco_categories', lambda: {1: 'person'})
+    tracker = SortTracker()
+    detected = tracker.step(1, ([[10.0, 20.0, 50.0, 100.0]], [0.9], ['person']))
+    predicted = tracker.step(2)
+    assert len(predicted) == 1
+
+    csv_path = str(tmp_path / 'fasterrcnn_detections_clip.csv')
+    with DetectionCsvWriter({'fasterrcnn': csv_path}) as writer:
+        for frame_number, inferred, rows in ((1, True, detected), (2, False, predicted)):
+            for track_id, box, score, label, source_frame in rows:
+                writer.write('fasterrcnn', {'timestamp': frame_number * 40.0, 'frame': frame_number, 'label': label,
+                                            'bounding_boxes': box, 'score': score, 'inferred': inferred,
+                                            'source_frame': source_frame, 'track_id': track_id})
+
+    table = read_detections(convert_csv_to_store(csv_path))
+    assert table.columns['frame'].tolist() == [1, 2]
+    assert table.columns['track_id'].tolist() == [1, 1]
+    assert np.allclose(table.boxes[1], predicted[0][1])
+
+
+def test_detections_match_the_overlapping_track_of_their_own_label():
+    tracker = SortTracker(iou_threshold=0.3)
+    first = tracker.step(1, ([[0.0, 0.0, 10.0, 10.0], [100.0, 100.0, 120.0, 120.0]], [0.9, 0.9], ['person', 'car']))
+    person_id, car_id = first[0][0], first[1][0]
+
+    # The dog covers the person's box exactly but may not take over its track
+    second = tracker.step(2, ([[101.0, 101.0, 121.0, 121.0], [1.0, 0.0, 11.0, 10.0], [0.0, 0.0, 10.0, 10.0]],
+                              [0.9, 0.9, 0.9], ['car', 'person', 'dog']))
+    assert [result[0] for result in second[:2]] == [car_id, person_id]
+    assert second[2][0] not in (person_id, car_id)
+
+
+def test_greedy_matching_gives_a_track_to_its_best_overlap():
+    tracker = SortTracker(iou_threshold=0.3)
+    track_id = tracker.step(1, ([[0.0, 0.0, 10.0, 10.0]], [0.9], ['person']))[0][0]
+
+    results = tracker.step(2, ([[3.0, 0.0, 13.0, 10.0], [1.0, 0.0, 11.0, 10.0]], [0.9, 0.9], ['person', 'person']))
+    assert results[1][0] == track_id
+    assert results[0][0] != track_id
+
+
+def test_track_is_dropped_after_max_age_unmatched_detector_runs():
+    tracker = SortTracker(max_age=2)
+    tracker.step(1, ([[0.0, 0.0, 10.0, 10.0]], [0.9], ['person']))
+
+    tracker.step(2, ([], [], []))
+    assert len(tracker.tracks) == 1
+    # Frames without a detector run do not age a track
+    tracker.step(3)
+    assert len(tracker.tracks) == 1
+    tracker.step(4, ([], [], []))
+    assert tracker.tracks == []
+    assert tracker.step(5) == []